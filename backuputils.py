@@ -0,0 +1,638 @@
+#########################################################################
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+"""Code shared by tarf.py and yarf.py."""
+
+import os, re, stat, fnmatch, threading, json
+from os import path
+from time import time, perf_counter, process_time
+from concurrent.futures import ThreadPoolExecutor
+
+
+_open_dirs = 64
+_plan_ext = '.plan'
+_re_variable = re.compile(r'\$(?:(?P<name>\w+)|\{(?P<braced>[^}]*)\})')
+_re_magic = re.compile(r'[*?[]')
+_glob_cache = {}
+_char_classes = {
+    'alnum':  'a-zA-Z0-9',
+    'alpha':  'a-zA-Z',
+    'blank':  r' \t',
+    'cntrl':  r'\x00-\x1f\x7f',
+    'digit':  '0-9',
+    'graph':  r'\x21-\x7e',
+    'lower':  'a-z',
+    'print':  r'\x20-\x7e',
+    'punct':  re.escape('!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~'),
+    'space':  r'\s',
+    'upper':  'A-Z',
+    'word':   r'\w',
+    'xdigit': '0-9A-Fa-f',
+}
+
+
+def removeTree(top, onerror, jobs=1):
+    parent, name = path.split(top.rstrip(os.sep))
+    if not name:
+        return removeFailed(onerror, top,
+                            "refusing to remove the root directory")
+    try:
+        dir_fd = os.open(parent or os.curdir, os.O_RDONLY | os.O_DIRECTORY)
+    except FileNotFoundError:
+        return 0, 0, 0
+    except OSError as e:
+        return removeFailed(onerror, parent, e.strerror)
+    try:
+        return removeAt(dir_fd, name, top, onerror, jobs)
+    finally:
+        os.close(dir_fd)
+
+def removeAt(dir_fd, name, display, onerror, jobs=1):
+    try:
+        st = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+        if not stat.S_ISDIR(st.st_mode):
+            os.unlink(name, dir_fd=dir_fd)
+            return 1, st.st_size if stat.S_ISREG(st.st_mode) else 0, 0
+    except FileNotFoundError:
+        return 0, 0, 0
+    except OSError as e:
+        return removeFailed(onerror, display, e.strerror)
+
+    # directories are removed depth first from an explicit stack, so that
+    # deep trees can't run into the recursion limit; below a certain depth,
+    # parents are closed and reopened through '..' to bound the open fds
+    total = [ 0, 0, 0 ]
+    stack = [ RemoveDir(dir_fd, name, display, st, onerror) ]
+    try:
+        while stack:
+            dir = stack[-1]
+            if not dir.opened:
+                dir.open(total)
+                if len(stack) > _open_dirs and dir.fd is not None:
+                    stack[-2].release()
+                    dir.dir_fd = None
+                if jobs > 1 and len(stack) == 1 and len(dir.subdirs) > 1:
+                    dir.removeSubdirs(total, jobs)
+            if dir.subdirs:
+                sub, st = dir.subdirs.pop()
+                stack.append(RemoveDir(dir.fd, sub,
+                                       path.join(dir.display, sub), st,
+                                       onerror))
+                continue
+
+            stack.pop()
+            if stack and stack[-1].fd is None:
+                stack[-1].reopen(dir, total)
+            dir.close(total)
+            if dir.errors and stack:
+                stack[-1].errors += dir.errors
+    finally:
+        for dir in stack:
+            if dir.fd is not None:
+                os.close(dir.fd)
+
+    return tuple(total)
+
+class RemoveDir:
+
+    def __init__(self, dir_fd, name, display, st, onerror):
+        self.dir_fd = dir_fd
+        self.name = name
+        self.display = display
+        self.st = st
+        self.onerror = onerror
+        self.fd = None
+        self.opened, self.gone = False, False
+        self.subdirs = []
+        self.errors = 0
+
+    def open(self, total):
+        self.opened = True
+        try:
+            self.fd = os.open(self.name,
+                              os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW,
+                              dir_fd=self.dir_fd)
+        except FileNotFoundError:
+            self.gone = True
+            return
+        except OSError as e:
+            return self.failed(total, e.strerror)
+
+        try:
+            fst = os.fstat(self.fd)
+            if (fst.st_dev, fst.st_ino) != (self.st.st_dev, self.st.st_ino):
+                return self.failed(total, "directory replaced during removal")
+
+            with os.scandir(self.fd) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        self.subdirs.append((entry.name, st))
+                    else:
+                        self.add(total, removeAt(self.fd, entry.name,
+                                                 path.join(self.display,
+                                                           entry.name),
+                                                 self.onerror))
+        except OSError as e:
+            self.failed(total, e.strerror)
+
+    def removeSubdirs(self, total, jobs):
+        with ThreadPoolExecutor(min(jobs, len(self.subdirs))) as executor:
+            for result in executor.map(
+                    lambda item: removeAt(self.fd, item[0],
+                                          path.join(self.display, item[0]),
+                                          self.onerror),
+                    self.subdirs):
+                self.add(total, result)
+        self.subdirs = []
+
+    def add(self, total, result):
+        for i in range(3):
+            total[i] += result[i]
+        self.errors += result[2]
+
+    def failed(self, total, msg):
+        self.subdirs = []
+        self.add(total, removeFailed(self.onerror, self.display, msg))
+
+    def release(self):
+        os.close(self.fd)
+        self.fd = None
+
+    def reopen(self, child, total):
+        if child.fd is None:
+            return
+        try:
+            fd = os.open(os.pardir, os.O_RDONLY | os.O_DIRECTORY,
+                         dir_fd=child.fd)
+        except OSError as e:
+            return self.failed(total, e.strerror)
+        fst = os.fstat(fd)
+        if (fst.st_dev, fst.st_ino) != (self.st.st_dev, self.st.st_ino):
+            os.close(fd)
+            return self.failed(total, "directory moved during removal")
+        self.fd = child.dir_fd = fd
+
+    def close(self, total):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.gone or self.errors or self.dir_fd is None:
+            return
+        try:
+            os.rmdir(self.name, dir_fd=self.dir_fd)
+            total[0] += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.add(total, removeFailed(self.onerror, self.display,
+                                          e.strerror))
+
+def removeFailed(onerror, name, msg):
+    onerror(name, msg)
+    return 0, 0, 1
+
+
+class DirCache:
+
+    def __init__(self):
+        self.cwd = os.getcwd()
+        self.listings = {}
+        self.stats = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, name, root=None):
+        if name in ('', os.curdir):
+            return root or self.cwd
+        name = path.join(root or self.cwd, name)
+        return name.rstrip(os.sep) or os.sep
+
+    def scandir(self, dir, root=None):
+        key = self.key(dir, root)
+        try:
+            entries = self.listings[key]
+        except KeyError:
+            self.misses += 1
+            try:
+                with os.scandir(key) as it:
+                    entries = { entry.name: entry for entry in it }
+            except OSError:
+                entries = None
+            self.listings[key] = entries
+        else:
+            self.hits += 1
+        return entries
+
+    def stat(self, name, root=None, follow=True):
+        return self.cachedStat(self.key(name, root),
+                               follow or name.endswith(os.sep))
+
+    def cachedStat(self, key, follow):
+        try:
+            st = self.stats[(key, follow)]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return st
+
+        if follow:
+            st = self.cachedStat(key, False)
+            if st is not None and not stat.S_ISLNK(st.st_mode):
+                self.stats[(key, True)] = st
+                return st
+
+        self.misses += 1
+        dir, base = path.split(key)
+        entries = self.listings.get(dir)
+        try:
+            if entries is None or base in (os.curdir, os.pardir):
+                st = os.stat(key, follow_symlinks=follow)
+            elif base in entries:
+                st = entries[base].stat(follow_symlinks=follow)
+            else:
+                st = None
+        except OSError:
+            st = None
+        self.stats[(key, follow)] = st
+        return st
+
+    def lexists(self, name, root=None):
+        return self.stat(name, root, follow=False) is not None
+
+    def isdir(self, name, root=None):
+        st = self.stat(name, root)
+        return st is not None and stat.S_ISDIR(st.st_mode)
+
+    def isfile(self, name, root=None):
+        st = self.stat(name, root)
+        return st is not None and stat.S_ISREG(st.st_mode)
+
+    def islink(self, name, root=None):
+        st = self.stat(name, root, follow=False)
+        return st is not None and stat.S_ISLNK(st.st_mode)
+
+    def invalidate(self, *names, root=None):
+        keys = { self.key(name, root) for name in names }
+        for key in keys:
+            self.listings.pop(path.dirname(key), None)
+        for cache in (self.listings, self.stats):
+            for k in list(cache):
+                name = k[0] if isinstance(k, tuple) else k
+                while name not in keys:
+                    parent = path.dirname(name)
+                    if parent == name:
+                        break
+                    name = parent
+                else:
+                    del cache[k]
+
+
+def extglob(dircache, pat, root=None):
+    return sorted(walkGlob(dircache, pat, root, compileExtglob,
+                           dotglob=True))
+
+def fileglob(dircache, pat, root=None):
+    return walkGlob(dircache, pat, root, compileGlob, dotglob=False)
+
+def walkGlob(dircache, pat, root, compile, dotglob):
+    parts = pat.split(os.sep)
+    comps = [ compile(part) for part in parts ]
+
+    if all(regex is None for regex, name in comps):
+        return [ pat ] if dircache.lexists(pat, root) else []
+
+    dirs_only = not parts[-1]
+    if dirs_only:
+        parts, comps = parts[:-1], comps[:-1]
+
+    matches = [ '' ]
+    for i, (regex, name) in enumerate(comps):
+        last = (i == len(comps) - 1)
+        found = []
+        if i == 0 and not parts[0]:
+            found.append(os.sep)
+        elif regex is None:
+            for match in matches:
+                entry = path.join(match, name)
+                if not last or dircache.lexists(entry, root):
+                    found.append(entry)
+        else:
+            hidden = dotglob or parts[i].startswith('.')
+            for match in matches:
+                entries = dircache.scandir(match or os.curdir, root)
+                if not entries:
+                    continue
+                for entry in entries.values():
+                    if not hidden and entry.name.startswith('.'):
+                        continue
+                    if regex.match(entry.name) and \
+                       (last and not dirs_only or entry.is_dir()):
+                        found.append(path.join(match, entry.name))
+        matches = found
+
+    if dirs_only:
+        matches = [ match + os.sep for match in matches
+                    if dircache.isdir(match, root) ]
+    return matches
+
+def compileGlob(part):
+    try:
+        return _glob_cache[(part, False)]
+    except KeyError:
+        if _re_magic.search(part):
+            comp = re.compile(fnmatch.translate(part)), None
+        else:
+            comp = None, part
+        _glob_cache[(part, False)] = comp
+        return comp
+
+def compileExtglob(part):
+    try:
+        return _glob_cache[(part, True)]
+    except KeyError:
+        tree = parseExtglob(part)
+        if not tree:
+            comp = None, ''
+        elif len(tree) == 1 and tree[0][0] == 'lit':
+            comp = None, tree[0][1]
+        else:
+            comp = re.compile(translateExtglob(tree, r'\Z') + r'\Z',
+                              re.DOTALL), None
+        _glob_cache[(part, True)] = comp
+        return comp
+
+def parseExtglob(pat, pos=0, group=False):
+    tree, alts, lit = [], [], ''
+
+    def flush():
+        nonlocal lit
+        if lit:
+            tree.append(('lit', lit))
+            lit = ''
+
+    while pos < len(pat):
+        char = pat[pos]
+        pos += 1
+        if char == '\\' and pos < len(pat):
+            lit += pat[pos]
+            pos += 1
+        elif group and char in '|)':
+            flush()
+            alts.append(tree)
+            tree = []
+            if char == ')':
+                return alts, pos
+        elif char in '?*+@!' and pat.startswith('(', pos) and \
+             parseExtglob(pat, pos + 1, group=True)[0] is not None:
+            flush()
+            sub, pos = parseExtglob(pat, pos + 1, group=True)
+            tree.append((char + '(', sub))
+        elif char in '?*':
+            flush()
+            tree.append((char, None))
+        elif char == '[' and bracketEnd(pat, pos) > 0:
+            flush()
+            end = bracketEnd(pat, pos)
+            tree.append(('[', pat[pos : end]))
+            pos = end + 1
+        else:
+            lit += char
+
+    if group:
+        return None, pos
+    flush()
+    return tree
+
+def bracketEnd(pat, pos):
+    end = pos
+    if pat.startswith(('!', '^'), end):
+        end += 1
+    if pat.startswith(']', end):
+        end += 1
+    while end < len(pat) and pat[end] != ']':
+        if pat.startswith('[:', end) and pat.find(':]', end + 2) >= 0:
+            end = pat.find(':]', end + 2) + 1
+        elif pat[end] == '\\':
+            end += 1
+        end += 1
+    return end if end < len(pat) else -1
+
+def translateExtglob(tree, after):
+    regex = ''
+    for kind, arg in reversed(tree):
+        if kind == 'lit':
+            node = re.escape(arg)
+        elif kind == '*':
+            node = '.*'
+        elif kind == '?':
+            node = '.'
+        elif kind == '[':
+            node = translateBracket(arg)
+        else:
+            alts = '|'.join(translateExtglob(alt, after) for alt in arg)
+            if kind == '!(':
+                node = '(?:(?!(?:' + alts + ')' + after + ').*?)'
+            elif kind == '@(':
+                node = '(?:' + alts + ')'
+            else:
+                node = '(?:' + alts + ')' + kind[0]
+        regex = node + regex
+        after = node + after
+    return regex
+
+def translateBracket(chars):
+    regex, pos = '[', 0
+    if chars.startswith(('!', '^')):
+        regex += '^'
+        pos += 1
+    while pos < len(chars):
+        char = chars[pos]
+        if chars.startswith('[:', pos) and chars.find(':]', pos + 2) >= 0:
+            end = chars.find(':]', pos + 2)
+            regex += _char_classes.get(chars[pos + 2 : end], '')
+            pos = end + 2
+            continue
+        elif char == '\\' and pos + 1 < len(chars):
+            pos += 1
+            regex += re.escape(chars[pos])
+        elif char == '-' and 0 < pos < len(chars) - 1 and \
+             not regex.endswith('['):
+            regex += '-'
+        else:
+            regex += re.escape(char)
+        pos += 1
+    return regex + ']'
+
+
+class Plan:
+
+    def __init__(self, version):
+        self.version = version
+        self.ops = []
+        self.files = {}
+        self.globs = []
+        self.env = {}
+
+    @classmethod
+    def load(cls, file, version):
+        try:
+            with open(file) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if data.get('version') != version:
+            return None
+        plan = cls(version)
+        plan.ops = data['ops']
+        plan.files = data['files']
+        plan.globs = data['globs']
+        plan.env = data['env']
+        return plan
+
+    def save(self, file):
+        data = {
+            'version': self.version,
+            'ops':     self.ops,
+            'files':   self.files,
+            'globs':   self.globs,
+            'env':     self.env,
+        }
+        os.makedirs(path.dirname(file), exist_ok=True)
+        temp = file + '.%d.%d' % (os.getpid(), threading.get_ident())
+        with open(temp, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(temp, file)
+
+    def isCurrent(self, dircache, glob):
+        try:
+            for file, mtime in self.files.items():
+                if os.stat(file).st_mtime_ns != mtime:
+                    return False
+        except OSError:
+            return False
+
+        for key, value in self.env.items():
+            if key.startswith('$'):
+                current = os.environ.get(key[1:])
+            else:
+                current = path.expanduser(key)
+            if current != value:
+                return False
+
+        for pat, matches in self.globs:
+            if glob(dircache, pat) != matches:
+                return False
+
+        return True
+
+    def addFile(self, file):
+        self.files[path.abspath(file)] = os.stat(file).st_mtime_ns
+
+    def addEnv(self, line):
+        # line is the pattern without its leading flags
+        if '$' in line:
+            for match in _re_variable.finditer(line):
+                name = match.group('name') or match.group('braced')
+                self.env['$' + name] = os.environ.get(name)
+        if line.startswith('~'):
+            user = line.split(os.sep, 1)[0]
+            self.env[user] = path.expanduser(user)
+
+def planPath(cache, prog, file, rundir):
+    import hashlib
+    key = '\0'.join((prog, path.realpath(file), rundir))
+    return path.join(cache, path.splitext(path.basename(file))[0] + '-' +
+                            hashlib.sha1(key.encode()).hexdigest()[:16] +
+                            _plan_ext)
+
+
+class Stats:
+
+    def __init__(self, *sections):
+        self.lock = threading.Lock()
+        self.start = time()
+        self.wall = perf_counter()
+        self.cpu = process_time()
+        self.phases = {}
+        self.children = {}
+        self.records = { section: [] for section in sections }
+
+    def phase(self, name, clock=process_time):
+        return Phase(self, name, clock)
+
+    def addPhase(self, name, wall, cpu):
+        with self.lock:
+            phase = self.phases.setdefault(name, { 'count': 0, 'wall': 0.0,
+                                                   'cpu': 0.0 })
+            phase['count'] += 1
+            phase['wall'] += wall
+            phase['cpu'] += cpu
+
+    def addChild(self, argv, wall, code):
+        with self.lock:
+            child = self.children.setdefault(path.basename(argv[0]), {
+                        'count': 0, 'failed': 0, 'wall': 0.0 })
+            child['count'] += 1
+            child['wall'] += wall
+            if code != 0:
+                child['failed'] += 1
+
+    def add(self, section, record):
+        with self.lock:
+            self.records.setdefault(section, []).append(record)
+
+    def save(self, file, **fields):
+        # fields describe the run, like the program and its exit status
+        children = { 'commands': self.children }
+        try:
+            import resource
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            children['user'], children['system'] = usage.ru_utime, usage.ru_stime
+        except ImportError:
+            pass
+
+        data = dict(fields)
+        data.update({
+            'start':    self.start,
+            'wall':     perf_counter() - self.wall,
+            'cpu':      process_time() - self.cpu,
+            'phases':   self.phases,
+            'children': children,
+        })
+        data.update(self.records)
+        temp = file + '.%d' % os.getpid()
+        with open(temp, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(temp, file)
+
+class Phase:
+
+    def __init__(self, stats, name, clock):
+        self.stats = stats
+        self.name = name
+        self.clock = clock
+
+    def __enter__(self):
+        self.wall, self.cpu = perf_counter(), self.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.addPhase(self.name, perf_counter() - self.wall,
+                            self.clock() - self.cpu)
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+#########################################################################
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+import sys, os, io, re, json, random, shutil, tempfile
+from os import path
+from time import perf_counter
+from contextlib import redirect_stdout, redirect_stderr
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+import tarf, yarf
+
+__usage__ = "Usage: %prog [-s SCALE] [-r N] [-k NAME]... [--save=FILE] [--compare=FILE]"
+__doc__ = """
+Time tarf.py and yarf.py against synthetic trees generated in a temporary
+directory: many small files, a few huge files, deep nesting and a farm of
+symbolic links. Each benchmark runs the tool's main() in-process and reports
+the wall time of the whole run and of each phase, as written by the tool's
+"--stats" option, along with the CPU time. The best of several runs is kept.
+
+Results can be saved as a baseline with "--save", and later runs compared
+against it with "--compare". The exit status is 1 if any benchmark got slower
+than the threshold allows.
+"""
+
+def ProgPrint(*args, sep=' ', end='\n', file=sys.stdout):
+    print(__prog__ + ': ' + sep.join(map(str, args)), end=end, file=file)
+
+
+def writeFile(name, size, rng, text=False):
+    with open(name, 'wb') as file:
+        while size > 0:
+            count = min(size, 1024 * 1024)
+            if text:
+                words = [ rng.choice(_words) for i in range(count // 6 + 1) ]
+                data = ' '.join(words).encode()[ : count]
+            else:
+                data = rng.randbytes(count)
+            file.write(data)
+            size -= count
+
+def makeTree(root, scale, seed=1):
+    rng = random.Random(seed)
+
+    small = path.join(root, 'small')
+    for i in range(max(1, int(200 * scale))):
+        dir = path.join(small, 'd%03d' % i)
+        os.makedirs(dir)
+        for j in range(50):
+            writeFile(path.join(dir, 'f%02d.txt' % j), rng.randrange(4096),
+                      rng, text=True)
+
+    huge = path.join(root, 'huge')
+    os.makedirs(huge)
+    for i in range(3):
+        writeFile(path.join(huge, 'h%d.bin' % i),
+                  max(1, int(32 * scale)) * 1024 * 1024, rng, text=(i == 0))
+
+    dir = path.join(root, 'deep')
+    for i in range(100):
+        dir = path.join(dir, 'd%d' % i)
+        os.makedirs(dir)
+        writeFile(path.join(dir, 'f'), rng.randrange(1024), rng, text=True)
+
+    links = path.join(root, 'links')
+    os.makedirs(links)
+    targets = sorted(os.listdir(small))
+    for i in range(max(1, int(2000 * scale))):
+        target = path.join(small, rng.choice(targets), 'f%02d.txt' % rng.randrange(50))
+        os.symlink(target, path.join(links, 'l%04d' % i))
+    for i, target in enumerate(targets[ : 50]):
+        os.symlink(path.join(small, target), path.join(links, 'dl%02d' % i))
+
+def makeDefinitions(root):
+    defs = path.join(root, 'defs')
+    os.makedirs(defs)
+    tree = path.join(root, 'tree')
+
+    definitions = {
+        'include.def': """
+            # pulled in with '@'
+            {tree}/./links
+        """,
+        'tarf.def': """
+            {tree}/./small
+            {tree}/huge/*
+            @ include.def
+            {tree}/deep/./d0
+            # % copies
+            % {tree}/small/d00*/f1*
+            % {tree}/deep/./d0/d1/d2/f
+        """,
+        'links.def': """
+            {tree}/links/l*
+            {tree}/links/dl*
+        """,
+        'extglob.def': """
+            {tree}/small/d+([0-9])/f@(1|2)*.txt
+            {tree}/small/d!(*5*)/*.txt
+            {tree}/./deep/**/f
+        """,
+        'yarf.def': """
+            {tree}/./small
+            {tree}/./deep
+            {tree}/huge/h0.bin
+            @ include.def
+        """,
+        'purge.def': """
+            ! {tree}/./small/*/*
+            {tree}/./small
+        """,
+    }
+    for name, text in definitions.items():
+        with open(path.join(defs, name), 'w') as file:
+            for line in text.strip().splitlines():
+                print(line.strip().format(tree=tree), file=file)
+    return defs
+
+def makeStale(dest, count):
+    for i in range(count):
+        dir = path.join(dest, 'small', 'd%03d' % (i % 200))
+        os.makedirs(dir, exist_ok=True)
+        with open(path.join(dir, 'stale%05d' % i), 'w') as file:
+            file.write('stale')
+
+def emptyDir(dir):
+    if path.lexists(dir):
+        shutil.rmtree(dir)
+    os.makedirs(dir)
+
+
+def timeRun(tool, argv):
+    fd, stats_file = tempfile.mkstemp(prefix='bench-', suffix='.json')
+    os.close(fd)
+    output = io.StringIO()
+    try:
+        with redirect_stdout(output), redirect_stderr(output):
+            wall = perf_counter()
+            status = tool.main([ tool.__name__ + '.py', '--stats=' + stats_file ]
+                               + argv)
+            wall = perf_counter() - wall
+        with open(stats_file) as file:
+            stats = json.load(file)
+    finally:
+        os.remove(stats_file)
+
+    if status != 0:
+        raise RuntimeError("%s exited with status %d:\n%s" %
+                           (' '.join([ tool.__name__ ] + argv), status,
+                            output.getvalue()))
+
+    return {
+        'wall':   wall,
+        'cpu':    stats['cpu'],
+        'phases': { name: phase['wall']
+                    for name, phase in stats['phases'].items() },
+    }
+
+def benchmarks(root, defs):
+    out = path.join(root, 'out')
+    dest = path.join(root, 'dest')
+    cache = path.join(root, 'cache')
+
+    def tarfBench(name, *args, defn='tarf.def'):
+        argv = [ '-f', '-t', out ] + list(args) + [ path.join(defs, defn) ]
+        return name, tarf, (lambda: emptyDir(out)), argv
+
+    def yarfBench(name, *args, defn='yarf.def', prepare=None):
+        argv = [ '--engine=native', '-t', dest ] + list(args) + \
+               [ path.join(defs, defn) ]
+        return name, yarf, prepare or (lambda: emptyDir(dest)), argv
+
+    def synced():
+        if not path.isdir(path.join(dest, 'small')):
+            emptyDir(dest)
+            timeRun(yarf, [ '--engine=native', '-t', dest,
+                            path.join(defs, 'yarf.def') ])
+
+    def stale():
+        synced()
+        makeStale(dest, 5000)
+
+    return [
+        tarfBench('tarf-expand', '-n'),
+        tarfBench('tarf-expand-cached', '-n', '--cache=' + cache),
+        tarfBench('tarf-extglob', '-n', '-e', defn='extglob.def'),
+        tarfBench('tarf-plain'),
+        tarfBench('tarf-gzip', '-z'),
+        tarfBench('tarf-xz', '-J'),
+        tarfBench('tarf-deref-L', '-L', defn='links.def'),
+        tarfBench('tarf-deref-H', '-H', defn='links.def'),
+        yarfBench('yarf-expand', '-nv'),
+        yarfBench('yarf-sync'),
+        yarfBench('yarf-resync', prepare=synced),
+        yarfBench('yarf-purge', defn='purge.def', prepare=stale),
+    ]
+
+def runBenchmarks(root, repeat, only):
+    defs = makeDefinitions(root)
+    results = {}
+
+    for name, tool, prepare, argv in benchmarks(root, defs):
+        if only and not any(re.search(pat, name) for pat in only):
+            continue
+        best = None
+        for i in range(repeat):
+            prepare()
+            result = timeRun(tool, argv)
+            if best is None or result['wall'] < best['wall']:
+                best = result
+        results[name] = best
+        ProgPrint("%-20s %8.3fs wall %8.3fs cpu  %s" %
+                  (name, best['wall'], best['cpu'],
+                   ' '.join('%s=%.3f' % item
+                            for item in sorted(best['phases'].items()))))
+    return results
+
+def compareResults(results, baseline, threshold):
+    regressions = 0
+    ProgPrint("compared with baseline (threshold %d%%):" % threshold)
+    for name, result in results.items():
+        if name not in baseline:
+            ProgPrint("%-20s %8.3fs  (new)" % (name, result['wall']))
+            continue
+        base = baseline[name]['wall']
+        change = (result['wall'] - base) / base * 100 if base else 0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        ProgPrint("%-20s %8.3fs  %8.3fs  %+7.1f%%%s" %
+                  (name, base, result['wall'], change, flag))
+    return regressions
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    global __prog__
+    __prog__ = path.basename(argv[0])
+
+    from optparse import OptionParser
+    parser = OptionParser(prog=__prog__, usage=__usage__, description=__doc__)
+    parser.add_option("-s", "--scale", type="float", default=1.0,
+                      help='multiply the size of the generated trees by SCALE '
+                           '(default is %default)')
+    parser.add_option("-r", "--repeat", metavar="N", type="int", default=3,
+                      help='run each benchmark N times and keep the fastest '
+                           '(default is %default)')
+    parser.add_option("-k", "--only", metavar="NAME", action="append",
+                      default=[],
+                      help='only run benchmarks whose names match the regular '
+                           'expression NAME')
+    parser.add_option("--save", metavar="FILE",
+                      help='save the results to FILE as a baseline')
+    parser.add_option("--compare", metavar="FILE",
+                      help='compare the results with the baseline in FILE')
+    parser.add_option("--threshold", metavar="PERCENT", type="int", default=10,
+                      help='with --compare, report benchmarks that are more '
+                           'than PERCENT slower than the baseline (default is '
+                           '%default)')
+    parser.add_option("--keep", default=False, action="store_true",
+                      help="don't remove the generated trees")
+    opts, args = parser.parse_args(argv[1:])
+
+    root = tempfile.mkdtemp(prefix='tarf-bench-')
+    try:
+        ProgPrint("generating trees in", root)
+        makeTree(path.join(root, 'tree'), opts.scale)
+        results = runBenchmarks(root, max(1, opts.repeat), opts.only)
+    finally:
+        if opts.keep:
+            ProgPrint("trees kept in", root)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    data = {
+        'scale':   opts.scale,
+        'results': results,
+    }
+    if opts.save:
+        with open(opts.save, 'w') as file:
+            json.dump(data, file, indent=2, sort_keys=True)
+        ProgPrint("results saved to", opts.save)
+
+    if opts.compare:
+        with open(opts.compare) as file:
+            baseline = json.load(file)
+        if baseline.get('scale') != opts.scale:
+            ProgPrint("warning: baseline was taken with scale",
+                      baseline.get('scale'), file=sys.stderr)
+        if compareResults(results, baseline['results'], opts.threshold):
+            return 1
+    return 0
+
+_words = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+          "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+if __name__ == '__main__':
+    sys.exit(main())
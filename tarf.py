@@ -23,14 +23,28 @@
 #
 #########################################################################
 
-import sys, os, signal, re
+import sys, os, io, signal, re, stat, tarfile, threading, json
 from os import path
-from glob import glob
 from subprocess import Popen, PIPE
-from time import strftime
+from time import strftime, time, perf_counter, thread_time
+from collections import deque
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from backuputils import DirCache, Plan, Stats, extglob, fileglob, \
+                        planPath, removeTree
 
 __version__ = "0.5"
-__usage__ = "Usage: %prog [-t DIRECTORY] [-a FMT] [-LHfvne] [-zj] FILE..."
+__usage__ = ("Usage: %prog [-t DIRECTORY] [-a FMT] [-g SNAPSHOT] [-LHfvne] "
+                       "[-zjJ] [--zstd] [--jobs=N] [--parallel=N] "
+                       "[--stats=FILE] [--progress=SECONDS] "
+                       "[--progress-file=FILE] [--store=DIR] [--seekable] "
+                       "[--checksums] [--dedupe] FILE...\n"
+                       "       %prog [--store=DIR] --export=MANIFEST\n"
+                       "       %prog [-t DIRECTORY] [-v] --extract MEMBER... "
+                       "ARCHIVE\n"
+                       "       %prog [-t DIRECTORY] [-v] [--jobs=N] "
+                       "--restore=ARCHIVE\n"
+                       "       %prog [--jobs=N] [--live] --verify ARCHIVE...")
 __doc__ = """
 Create tar archives according to patterns read from files on the command line,
 then optionally compress them. Each file will create a single archive in the
@@ -51,11 +65,11 @@ If a line starts with '%(_link_chr)c', lines from files matching the pattern are
 they were in the current input file.
 
 If a pattern is prefixed with the "copy" character ('%(_copy_chr)c'), all matching files
-will first be copied to a temporary directory in the target directory, which
-will then be added to the tar file and removed. The temp directory would take
-the name of the corresponding input file without the suffix unless a comment
-starting with '%(_copy_chr)c' precedes the file list. For example, if the input file
-"configs.def" contained
+will be added to the tar file under a top-level directory, as if they had been
+copied there with their implied directories. Nothing is copied on disk. The
+directory would take the name of the corresponding input file without the
+suffix unless a comment starting with '%(_copy_chr)c' precedes the file list. For
+example, if the input file "configs.def" contained
 
     %(_copy_chr)c ~/.vimrc
     # %(_copy_chr)c bash config
@@ -63,8 +77,8 @@ starting with '%(_copy_chr)c' precedes the file list. For example, if the input
     # %(_copy_chr)c uzbl stuff
     %(_copy_chr)c $XDG_DATA_HOME/uzbl/scripts/
 
-then .vimrc would be copied to a new temporary directory "configs" in the
-target directory, .bashrc to "bash", and the directory scripts to "uzbl".
+then .vimrc would be added to the tar file as "configs/.vimrc", .bashrc as
+"bash/.bashrc", and the directory scripts as "uzbl/scripts".
 
 Implied directories can be specified in the pattern to preserve directory
 structure. This is done with the first "/./" marker in the file pattern. Also,
@@ -76,27 +90,103 @@ the third will only add "bar" to the tar file:
     ~/1/./foo/bar
     ~/2/*/bar
     ~/3/foo/bar
+
+With the "-g" option, a snapshot of every archived file is kept in a separate
+file, and later runs only add files that are new or have changed since then
+(directories are always added). The names of members that have disappeared
+are stored, separated by NUL characters, in a last member named
+"%(_deleted_name)s".
+
+Archives compressed with gzip, bzip2 or xz are compressed in blocks on several
+threads at once (see the "--jobs" option). The result is a standard
+multi-member file that can be decompressed with the usual tools. Archives
+compressed with zstd are piped through the `zstd' command, which uses the same
+number of threads.
+
+With the "--parallel" option, archives for several input files are created at
+the same time. The output for each file is held back and printed in the order
+the files were given on the command line.
+
+The patterns of each file, including those of files pulled in with "@", are
+expanded on the same number of threads as the compression. The entries found
+and any messages are collected and applied in the order of the patterns, so
+the archive is the same as with a single thread.
+
+The "--progress" option reports, for each archive being written, how much of
+its input has been read and how much output has been written, along with the
+number of files per second, the throughput, the compression ratio and an
+estimate of the time left. The size of the input is not measured beforehand:
+it is taken from the snapshot of the last run with "-g", or else estimated from
+the bytes found so far and the share of the patterns' entries done. With
+"--progress-file", the same figures are written as JSON to a file that is
+replaced at each interval.
+
+With the "--store" option, no archive is written. Instead, the contents of
+each file are split into chunks at points that depend on the data, and each
+chunk is stored once, named after its SHA-256 digest, in the given directory.
+A manifest listing the members of the archive and their chunks is written in
+place of the archive, with a "%(_manifest_ext)s" suffix. Chunks that are already in the
+store are not written again, so successive runs over mostly unchanged files
+only add the chunks that changed. Chunks are compressed if "-z", "-j" or "-J"
+is given. A standard tar archive can be made from a manifest with "--export",
+which writes it to standard output.
+
+With the "--seekable" option, an index of the offset of every member is
+written next to each archive, with a "%(_index_ext)s" suffix. Since archives are
+compressed in independent blocks, members can then be extracted with
+"--extract" by decompressing only the blocks that hold them. This works with
+uncompressed archives and with gzip, bzip2 and xz, but not zstd. Without an
+index, "--extract" reads the archive from the start.
+
+The "--restore" option extracts a whole archive into the target directory.
+The archive is decompressed and read on one thread while files are created,
+written and given their attributes on "--jobs" threads. Hard links and the
+attributes of directories are dealt with last. Members that would end up
+outside the target directory are skipped, and the files listed in the
+"%(_deleted_name)s" member of an incremental archive are removed, so a full
+archive and the incremental archives made after it can be restored in order.
+
+With the "--checksums" option, the SHA-256 digest of every file member is
+computed as it is written, along with that of the whole archive, and saved
+next to the archive with a "%(_sums_ext)s" suffix. The "--verify" option checks
+archives against these digests: the archive file is hashed on one thread
+while its members are decompressed and hashed on the others. With "--live",
+the files the members were read from are checked instead, to find out which
+of them have changed since the archive was made.
+
+A file that is reached more than once, whether through hard links, through
+symbolic links followed with "-L" or "-H" or through copies made with "%(_copy_chr)c",
+is stored only once; later occurrences are written as hard links to the
+first. With "--dedupe", files with the same contents, mode, owner, group and
+modification time as a file already in the archive are written as hard links
+too. Only files whose size and attributes match one already written are read
+and hashed to find out. Either way, such files are extracted as hard links to
+each other, so copies that were separate files share one inode once restored.
 """
 
 __debugging__ = False
 
-def Debug(*args, sep=' ', file=sys.stderr):
+def Debug(*args, sep=' ', file=None):
     if __debugging__:
-        ProgPrint(*args, name="db", sep=sep, file=file)
+        ProgPrint(*args, name="db", sep=sep, file=file or sys.stderr)
 
-def ProgPrint(*args, name=None, sep=' ', end='\n', file=sys.stdout):
+def ProgPrint(*args, name=None, sep=' ', end='\n', file=None):
     if name is None:
         name = __prog__
+    if file is None:
+        file = sys.stdout
     if len(args) == 0:
         print(file=file, end=end)
     else:
         print(name+': '+sep.join(map(str, args)), end=end, file=file)
 
-def TestPrint(condition, *args, sep=' ', end='\n', file=sys.stdout):
+def TestPrint(condition, *args, sep=' ', end='\n', file=None):
     if condition:
         ProgPrint(*args, sep=sep, end=end, file=file)
 
-def PrintError(*args, sep=': ', end='\n', file=sys.stderr):
+def PrintError(*args, sep=': ', end='\n', file=None):
+    if file is None:
+        file = sys.stderr
     pargs = []
     for arg in args:
         if arg is not None and arg != '':
@@ -143,16 +233,33 @@ def handler(signum, frame):
 def shortPath(path):
     return _re_home.sub('~', path)
 
-def walkRemove(top):
-    if path.isfile(top) or path.islink(top):
-        os.remove(top)
-    elif path.isdir(top):
-        for root, dirs, files in os.walk(top, topdown=False):
-            for name in files:
-                os.remove(path.join(root, name))
-            for name in dirs:
-                os.rmdir(path.join(root, name))
-        os.rmdir(top)
+def removeFailed(name, msg):
+    PrintError("error removing destination file", shortPath(name), msg)
+    updateStatus(1)
+
+def userName(uid):
+    try:
+        return _unames[uid]
+    except KeyError:
+        try:
+            import pwd
+            name = pwd.getpwuid(uid).pw_name
+        except (ImportError, KeyError):
+            name = ''
+        _unames[uid] = name
+        return name
+
+def groupName(gid):
+    try:
+        return _gnames[gid]
+    except KeyError:
+        try:
+            import grp
+            name = grp.getgrgid(gid).gr_name
+        except (ImportError, KeyError):
+            name = ''
+        _gnames[gid] = name
+        return name
 
 def confirmRemove(file):
     if path.islink(file):
@@ -167,12 +274,16 @@ def confirmRemove(file):
     if _force:
         return True
 
-    PrintError("overwrite existing", filetype, shortPath(file) + "? [y/N] ",
-               sep=' ', end='')
-    try:
-        reply = input()
-    except EOFError:
-        reply = ''
+    with _prompt_lock:
+        stderr = sys.stderr
+        if isinstance(stderr, ThreadOutput):
+            stderr = stderr.file
+        PrintError("overwrite existing", filetype, shortPath(file) + "? [y/N] ",
+                   sep=' ', end='', file=stderr)
+        try:
+            reply = input()
+        except EOFError:
+            reply = ''
     if reply.startswith('y') or reply.startswith('Y'):
         return True
     else:
@@ -183,18 +294,40 @@ def safeRemove(file, force=False):
         return True
 
     if force or confirmRemove(file):
-        try:
-            walkRemove(file)
-            return True
-        except OSError as e:
-            PrintError(e.filename, e.strerror)
-            updateStatus(1)
-            return False
+        count, size, errors = removeTree(file, removeFailed, _jobs)
+        return errors == 0
     else:
         return False
 
+def startProc(argv, stdin=None, stdout=None, stderr=None):
+    started = perf_counter()
+    try:
+        proc = Popen(argv, stdin=stdin, stdout=stdout, stderr=stderr)
+    except OSError:
+        raise Fatal(127, argv[0], "command not found")
+
+    proc.started = started
+    _children.add(proc)
+    return proc
+
+def waitProc(proc, ignore_code=False):
+    if proc.stdin:
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+    code = proc.wait()
+    _children.discard(proc)
+    _stats.addChild(proc.args, perf_counter() - proc.started, code)
+
+    if code != 0 and not ignore_code:
+        updateStatus(code)
+
+    return code
+
 def runProc(argv, stdout=None, stderr=None, input=None, text=True,
             ignore_code=False):
+    started = perf_counter()
     try:
         proc = Popen(argv, stdout=stdout, stderr=stderr,
                      stdin=(None if input is None else PIPE),
@@ -212,11 +345,90 @@ def runProc(argv, stdout=None, stderr=None, input=None, text=True,
     _children.remove(proc)
 
     code = proc.poll()
+    _stats.addChild(argv, perf_counter() - started, code)
     if code != 0 and not ignore_code:
         updateStatus(code)
 
     return out, err, code
 
+class ThreadOutput:
+
+    def __init__(self, file, local):
+        self.file = file
+        self.local = local
+
+    def write(self, s):
+        output = getattr(self.local, 'output', None)
+        if output is None:
+            return self.file.write(s)
+        output.append((self.file, s))
+        return len(s)
+
+    def flush(self):
+        if getattr(self.local, 'output', None) is None:
+            self.file.flush()
+
+class OutputStream:
+
+    def __init__(self, file):
+        self.file = file
+        self.offset = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+class BlockCompressor:
+
+    def __init__(self, file, method, jobs):
+        self.file = file
+        self.compress = _block_compressors[method]
+        self.blocksize = _block_sizes[method]
+        self.buf = bytearray()
+        self.pending = deque()
+        self.max_pending = 2 * jobs
+        self.executor = ThreadPoolExecutor(jobs)
+        self.offset = 0
+        self.frames = []
+
+    def write(self, data):
+        self.buf += data
+        while len(self.buf) >= self.blocksize:
+            self.submit(bytes(self.buf[ : self.blocksize]))
+            del self.buf[ : self.blocksize]
+        return len(data)
+
+    def submit(self, block):
+        if len(self.pending) >= self.max_pending:
+            self.writeFrame(self.pending.popleft().result())
+        self.pending.append(self.executor.submit(self.timedCompress, block))
+
+    def writeFrame(self, data):
+        self.frames.append(self.offset)
+        self.file.write(data)
+        self.offset += len(data)
+
+    def timedCompress(self, block):
+        # worker threads only count their own time, as blocks overlap
+        with _stats.phase('compress', thread_time):
+            return self.compress(block)
+
+    def close(self):
+        if self.buf:
+            self.submit(bytes(self.buf))
+            self.buf.clear()
+        while self.pending:
+            self.writeFrame(self.pending.popleft().result())
+        self.executor.shutdown()
+
+    def abort(self):
+        self.pending.clear()
+        self.executor.shutdown(cancel_futures=True)
+
 class FileCollection:
 
     def __init__(self, name):
@@ -245,13 +457,11 @@ class FileCollection:
     def commit(self):
         if self.status is not None:
             return False
-        elif not self.queues:
+        elif self.isEmpty():
             return True
         elif not self.prep():
             return False
 
-        working_dir = os.getcwd()
-
         try:
             return self.checkedCommit()
 
@@ -260,8 +470,8 @@ class FileCollection:
             updateStatus(1)
             return False
 
-        finally:
-            os.chdir(working_dir)
+    def isEmpty(self):
+        return not self.queues
 
     def checkedCommit(self):
         return NotImplemented
@@ -277,117 +487,1391 @@ class FileCollection:
 class Archive(FileCollection):
 
     def __init__(self, base, ext):
-        super().__init__(base + _tar_ext)
         if ext and ext != _tar_ext:
-            self.final_name = base + ext
+            final_name = base + ext
         else:
-            self.final_name = base + _tar_ext
+            final_name = base + _tar_ext
             if _compress:
-                self.final_name += _compressed_exts[_compress[0]]
+                final_name += _compressed_exts[_compress]
+        super().__init__(final_name)
+        self.final_name = final_name
+        self.tempdirs = []
+        self.tempdir = None
+        self.snapshot = None
+        self.last_snapshot = {}
+        self.counter = None
+        self.stats = { 'queues': [], 'tempdirs': [] }
+
+    def setTempdir(self, name):
+        for td in self.tempdirs:
+            if td.name == name:
+                self.tempdir = td
+                return
+        self.tempdir = FileCollection(name)
+        self.tempdirs.append(self.tempdir)
+
+    def isEmpty(self):
+        return not self.queues and not any(td.queues for td in self.tempdirs)
 
     def checkedCommit(self):
         TestPrint(_verbose, "creating", self.name, "in", shortPath(_target))
 
-        for base, follow in self.queues.keys():
-            os.chdir(base)
+        with open(self.path, 'wb') as raw:
+            self.startCommit(raw)
+            file = HashingFile(raw) if _checksums else raw
+            self.sums = {} if _checksums else None
+
+            proc, compressor, tee, tee_errors = None, None, None, []
+            if _compress_cmd and _checksums:
+                TestPrint(_verbose, "compressing with", _compress)
+                proc = startProc(_compress_cmd, stdin=PIPE, stdout=PIPE)
+                tee = threading.Thread(target=copyData,
+                                       args=(proc.stdout, file, tee_errors))
+                tee.start()
+                out = proc.stdin
+            elif _compress_cmd:
+                TestPrint(_verbose, "compressing with", _compress)
+                proc = startProc(_compress_cmd, stdin=PIPE, stdout=file)
+                out = proc.stdin
+            elif _compress:
+                TestPrint(_verbose, "compressing with", _compress,
+                          "(%d jobs)" % _jobs)
+                compressor = BlockCompressor(file, _compress, _jobs)
+                out = compressor
+            else:
+                out = file
 
-            options = [ '--dereference' ] if follow else []
-            srcList = self.queues[(base, follow)]
+            if _progress is not None:
+                _progress.add(self)
 
-            if self.status is None:
-                code = runProc(_tar_create + [ self.path ] + options + srcList)[2]
-                if path.exists(self.path):
-                    self.status = True
-                else:
-                    self.status = False
+            self.index = {} if _seekable else None
+            try:
+                tar = tarfile.open(fileobj=OutputStream(out), mode='w',
+                                   format=tarfile.GNU_FORMAT)
+                self.writeMembers(tar)
+                tar.close()
+                if compressor is not None:
+                    compressor.close()
+                if self.index is not None:
+                    self.saveIndex(raw, compressor)
+            finally:
+                if compressor is not None:
+                    compressor.abort()
+                if proc is not None and waitProc(proc) != 0:
+                    self.errors += 1
+                if tee is not None:
+                    tee.join()
+                for e in tee_errors:
+                    PrintError(shortPath(self.path), e.strerror)
+                    self.errors += 1
+                if _progress is not None:
+                    _progress.remove(self)
+
+            if self.sums is not None and self.errors == 0:
+                self.saveSums(raw, file.digest.hexdigest())
+
+        return self.errors == 0
+
+    def saveSums(self, file, digest):
+        file.flush()
+        data = {
+            'format':  _sums_format,
+            'archive': self.name,
+            'size':    os.fstat(file.fileno()).st_size,
+            'sha256':  digest,
+            'members': self.sums,
+        }
+        name = self.path + _sums_ext
+        temp = name + '.%d.%d' % (os.getpid(), threading.get_ident())
+        with open(temp, 'w') as f:
+            json.dump(data, f, indent=1)
+        os.replace(temp, name)
+        TestPrint(_verbose, "wrote checksums of", len(self.sums), "members to",
+                  self.name + _sums_ext)
+
+    def saveIndex(self, file, compressor):
+        file.flush()
+        data = {
+            'format':    _index_format,
+            'size':      os.fstat(file.fileno()).st_size,
+            'compress':  _compress,
+            'blocksize': compressor and compressor.blocksize,
+            'frames':    compressor and compressor.frames,
+            'members':   self.index,
+        }
+        name = self.path + _index_ext
+        temp = name + '.%d.%d' % (os.getpid(), threading.get_ident())
+        with open(temp, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(temp, name)
+        TestPrint(_verbose, "wrote index of", len(self.index), "members to",
+                  self.name + _index_ext)
+
+    def startCommit(self, file):
+        self.status = True
+        st = os.fstat(file.fileno())
+        self.inode = (st.st_dev, st.st_ino)
+        self.inodes = {}
+        self.contents = {} if _dedupe else None
+        self.links = [ 0, 0 ]
+        self.errors = 0
+        self.fileno = file.fileno()
+        self.read_bytes, self.members = 0, 0
+        self.scanned, self.entries_done = 0, 0
+        self.entries = sum(map(len, self.queues.values())) + \
+                       sum(sum(map(len, td.queues.values()))
+                           for td in self.tempdirs)
+        self.last_total = None
+        if _progress is not None and self.last_snapshot:
+            self.last_total = sum(record[1]
+                                  for record in self.last_snapshot.values())
+
+    def writeMembers(self, tar):
+        for base, follow in self.queues.keys():
+            self.counter = [ 0, 0 ]
+            for entry in self.queues[(base, follow)]:
+                self.addMember(tar, path.join(base, entry), entry, follow)
+                self.entries_done += 1
+            self.stats['queues'].append({
+                'base':    base,
+                'follow':  follow,
+                'entries': len(self.queues[(base, follow)]),
+                'members': self.counter[0],
+                'bytes':   self.counter[1],
+            })
+        for td in self.tempdirs:
+            if td.queues:
+                self.counter = [ 0, 0 ]
+                with _stats.phase('tempdir'):
+                    self.addTempdir(tar, td)
+                self.stats['tempdirs'].append({
+                    'name':    td.name,
+                    'entries': sum(map(len, td.queues.values())),
+                    'members': self.counter[0],
+                    'bytes':   self.counter[1],
+                })
+        self.counter = None
+        self.stats['links'] = { 'members': self.links[0],
+                                'bytes':   self.links[1] }
+        TestPrint(_verbose and self.links[0], "linked", self.links[0],
+                  "repeated files, saving", formatSize(self.links[1]))
+        if self.snapshot is not None:
+            self.addDeleted(tar)
+
+    def progress(self):
+        try:
+            written = os.fstat(self.fileno).st_size
+        except OSError:
+            written = None
+        return self.read_bytes, written, self.members
+
+    def position(self):
+        # bytes of the input dealt with, whether read or skipped
+        return self.scanned + self.read_bytes
+
+    def estimate(self):
+        # sizes from the last snapshot, or the bytes found so far scaled up
+        # by the share of entries done; nothing is stat'ed twice
+        if self.last_total is not None:
+            return max(self.last_total, self.position())
+        if self.entries_done == 0:
+            return None
+        return self.position() * self.entries // self.entries_done
+
+    def addTempdir(self, tar, td):
+        TestPrint(_verbose, "adding copied files under", td.name + os.sep)
+
+        tarinfo = tarfile.TarInfo(td.name)
+        tarinfo.type = tarfile.DIRTYPE
+        tarinfo.mode = 0o777 & ~_umask
+        tarinfo.uid, tarinfo.gid = os.geteuid(), os.getegid()
+        tarinfo.uname = userName(tarinfo.uid)
+        tarinfo.gname = groupName(tarinfo.gid)
+        tarinfo.mtime = time()
+        self.writeMember(tar, tarinfo)
+
+        seen = { td.name }
+
+        for base, follow in td.queues.keys():
+            for entry in td.queues[(base, follow)]:
+                parent = ''
+                for part in path.dirname(path.normpath(entry)).split(os.sep):
+                    if not part:
+                        continue
+                    parent = path.join(parent, part)
+                    arcname = path.join(td.name, parent)
+                    if arcname in seen:
+                        continue
+                    seen.add(arcname)
+                    try:
+                        st = os.stat(path.join(base, parent))
+                        self.writeMember(tar, self.memberInfo(
+                                path.join(base, parent), arcname, st))
+                    except OSError as e:
+                        PrintError(e.filename, e.strerror)
+                        self.errors += 1
+                        updateStatus(1)
+
+                self.addMember(tar, path.join(base, entry),
+                               path.normpath(path.join(td.name, entry)),
+                               follow, seen=seen)
+                self.entries_done += 1
+
+    def addMember(self, tar, name, arcname, follow, parents=(), seen=None):
+        if _abort.is_set():
+            raise Exit(1, "aborted")
+        if seen is not None:
+            if arcname in seen:
+                return
+            seen.add(arcname)
+
+        try:
+            st = os.stat(name) if follow else os.lstat(name)
+            if (st.st_dev, st.st_ino) == self.inode:
+                PrintError(shortPath(name), "file is the archive; not dumped")
+                return
+            tarinfo = self.memberInfo(name, arcname, st)
+            if tarinfo is None:
+                PrintError(shortPath(name), "socket ignored")
+                return
+
+            if not self.isChanged(tarinfo, st):
+                self.scanned += st.st_size
+            elif tarinfo.isreg() and not self.isCopy(name, tarinfo):
+                with open(name, 'rb') as file:
+                    self.writeMember(tar, tarinfo, file, name)
+                self.inodes[(st.st_dev, st.st_ino)] = tarinfo.name
             else:
-                code = runProc(_tar_append + [ self.path ] + options + srcList)[2]
+                self.writeMember(tar, tarinfo)
+                self.scanned += st.st_size
+                if tarinfo.islnk():
+                    self.inodes[(st.st_dev, st.st_ino)] = tarinfo.linkname
+                    self.links[0] += 1
+                    self.links[1] += st.st_size
+
+            if tarinfo.isdir():
+                inode = (st.st_dev, st.st_ino)
+                if inode in parents:
+                    PrintError(shortPath(name), "file system loop detected")
+                    self.errors += 1
+                    updateStatus(1)
+                    return
+                for entry in sorted(os.listdir(name)):
+                    self.addMember(tar, path.join(name, entry),
+                                   path.join(arcname, entry), follow,
+                                   parents + (inode,), seen)
+
+        except OSError as e:
+            PrintError(e.filename, e.strerror)
+            self.errors += 1
+            updateStatus(1)
+
+    def isChanged(self, tarinfo, st):
+        if self.snapshot is None:
+            return True
 
-            if code != 0:
-                return False
+        record = [ st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns ]
+        self.snapshot[tarinfo.name] = record
+        return tarinfo.isdir() or self.last_snapshot.get(tarinfo.name) != record
 
+    def addDeleted(self, tar):
+        deleted = [ name for name in self.last_snapshot
+                    if name not in self.snapshot ]
+        TestPrint(_verbose, "incremental:", len(self.snapshot), "entries,",
+                  len(deleted), "deleted since the last snapshot")
+        if not deleted:
+            return
+
+        data = '\0'.join(deleted).encode(tar.encoding, tar.errors)
+        tarinfo = tarfile.TarInfo(_deleted_name)
+        tarinfo.size = len(data)
+        tarinfo.mode = 0o666 & ~_umask
+        tarinfo.uid, tarinfo.gid = os.geteuid(), os.getegid()
+        tarinfo.uname = userName(tarinfo.uid)
+        tarinfo.gname = groupName(tarinfo.gid)
+        tarinfo.mtime = time()
+        self.writeMember(tar, tarinfo, io.BytesIO(data))
+
+    def isCopy(self, name, tarinfo):
+        key = contentKey(tarinfo)
+        if self.contents is None or key not in self.contents or \
+           tarinfo.size == 0:
+            return False
+
+        # only files of the same size and attributes as one already written
+        # are read twice; a link would give them that file's attributes
+        with open(name, 'rb') as file:
+            digest = _sha256()
+            for data in iter(lambda: file.read(_bufsize), b''):
+                digest.update(data)
+        linkname = self.contents[key].get(digest.hexdigest())
+        if linkname is None:
+            return False
+
+        tarinfo.type = tarfile.LNKTYPE
+        tarinfo.linkname = linkname
+        tarinfo.size = 0
         return True
 
-    def compressAndReplace(self):
-        if self.status is not True:
-            return True
+    def memberInfo(self, name, arcname, st):
+        tarinfo = tarfile.TarInfo(arcname.lstrip(os.sep))
+        mode = st.st_mode
 
-        if _compress:
-            new_path = path.join(_dest, self.final_name)
-            if not safeRemove(new_path):
-                return False
+        if stat.S_ISREG(mode):
+            inode = (st.st_dev, st.st_ino)
+            if inode in self.inodes:
+                tarinfo.type = tarfile.LNKTYPE
+                tarinfo.linkname = self.inodes[inode]
+            else:
+                tarinfo.type = tarfile.REGTYPE
+                tarinfo.size = st.st_size
+        elif stat.S_ISDIR(mode):
+            tarinfo.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(mode):
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = os.readlink(name)
+        elif stat.S_ISFIFO(mode):
+            tarinfo.type = tarfile.FIFOTYPE
+        elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+            tarinfo.type = (tarfile.CHRTYPE if stat.S_ISCHR(mode)
+                                            else tarfile.BLKTYPE)
+            tarinfo.devmajor = os.major(st.st_rdev)
+            tarinfo.devminor = os.minor(st.st_rdev)
+        else:
+            return None
+
+        tarinfo.mode = stat.S_IMODE(mode)
+        tarinfo.uid, tarinfo.gid = st.st_uid, st.st_gid
+        tarinfo.uname, tarinfo.gname = userName(st.st_uid), groupName(st.st_gid)
+        tarinfo.mtime = st.st_mtime
+        return tarinfo
+
+    def writeMember(self, tar, tarinfo, file=None, name=None):
+        if self.counter is not None:
+            self.counter[0] += 1
+            if file is not None:
+                self.counter[1] += tarinfo.size
+        self.members += 1
+        if self.index is not None:
+            self.index[tarinfo.name] = tar.offset
+        buf = tarinfo.tobuf(tar.format, tar.encoding, tar.errors)
+        tar.fileobj.write(buf)
+        tar.offset += len(buf)
+
+        if file is not None:
+            digest = None
+            if self.sums is not None or self.contents is not None:
+                digest = _sha256()
+            for data in self.readData(file, tarinfo, name):
+                tar.fileobj.write(data)
+                if digest is not None:
+                    digest.update(data)
+            if self.sums is not None:
+                self.sums[tarinfo.name] = [ digest.hexdigest(), name and
+                                            path.abspath(name) ]
+            if self.contents is not None and name is not None:
+                self.contents.setdefault(contentKey(tarinfo), {})[
+                        digest.hexdigest()] = tarinfo.name
+
+            blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+            if remainder > 0:
+                tar.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+                blocks += 1
+            tar.offset += blocks * tarfile.BLOCKSIZE
+
+    def readData(self, file, tarinfo, name):
+        remaining = tarinfo.size
+        while remaining > 0:
+            if _abort.is_set():
+                raise Exit(1, "aborted")
+            data = file.read(min(remaining, _bufsize))
+            if not data:
+                PrintError(shortPath(name), "file shrank by %d bytes; "
+                           "padding with zeros" % remaining)
+                self.errors += 1
+                updateStatus(1)
+                while remaining > 0:
+                    data = bytes(min(remaining, _bufsize))
+                    yield data
+                    remaining -= len(data)
+                return
+            remaining -= len(data)
+            self.read_bytes += len(data)
+            yield data
+
+        # like tar, keep what was read, but warn if the file grew or was
+        # written to in the meantime
+        if name is not None:
+            st = os.fstat(file.fileno())
+            if st.st_size != tarinfo.size or st.st_mtime != tarinfo.mtime:
+                PrintError(shortPath(name), "file changed as we read it")
+                updateStatus(1)
+
+class StoreArchive(Archive):
 
-            TestPrint(_verbose, "compressing with", _compress[0])
+    def __init__(self, base, ext):
+        super().__init__(base, ext)
+        self.name = self.final_name = base + _manifest_ext
+        self.path = path.join(_dest, self.name)
 
+    def checkedCommit(self):
+        TestPrint(_verbose, "creating", self.name, "in", shortPath(_target),
+                  "with chunks in", shortPath(_store.root))
+
+        with open(self.path, 'w') as file:
+            self.startCommit(file)
+            self.sums = None
+            manifest = Manifest(file)
+            manifest.write({
+                'format':   _manifest_format,
+                'version':  __version__,
+                'name':     self.name,
+                'store':    _store.root,
+                'compress': _compress,
+                'time':     time(),
+            })
+
+            if _progress is not None:
+                _progress.add(self)
+            before = dict(_store.stats)
             try:
-                with open(new_path, 'wb') as compressed:
-                    code = runProc(_compress + [ self.path ],
-                                   stdout=compressed, text=False)[2]
-                    if self.remove():
-                        self.path = new_path
-                        self.name = self.final_name
-                    else:
-                        safeRemove(new_path, force=True)
-                        return False
+                self.writeMembers(manifest)
+            finally:
+                if _progress is not None:
+                    _progress.remove(self)
+                self.stats['chunks'] = { key: _store.stats[key] - before[key]
+                                         for key in before }
+
+        return self.errors == 0
+
+    def progress(self):
+        return self.read_bytes, _store.stats['written'], self.members
+
+    def writeMember(self, tar, tarinfo, file=None, name=None):
+        if self.counter is not None:
+            self.counter[0] += 1
+            if file is not None:
+                self.counter[1] += tarinfo.size
+        self.members += 1
+
+        record = {
+            'name':     tarinfo.name,
+            'type':     tarinfo.type.decode(),
+            'mode':     tarinfo.mode,
+            'uid':      tarinfo.uid,
+            'gid':      tarinfo.gid,
+            'uname':    tarinfo.uname,
+            'gname':    tarinfo.gname,
+            'mtime':    tarinfo.mtime,
+        }
+        if tarinfo.linkname:
+            record['linkname'] = tarinfo.linkname
+        if tarinfo.ischr() or tarinfo.isblk():
+            record['devmajor'] = tarinfo.devmajor
+            record['devminor'] = tarinfo.devminor
+
+        if file is not None:
+            chunker = Chunker()
+            futures = []
+            for data in self.readData(file, tarinfo, name):
+                futures += map(_store.put, chunker.feed(data))
+            futures += map(_store.put, chunker.feed(b'', final=True))
+            record['size'] = tarinfo.size
+            record['chunks'] = [ future.result() for future in futures ]
+
+        tar.write(record)
+
+class Manifest:
+
+    def __init__(self, file):
+        self.file = file
+        self.encoding = tarfile.ENCODING
+        self.errors = 'surrogateescape'
+
+    def write(self, record):
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+class Chunker:
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data, final=False):
+        self.buf += data
+        buf, pattern = self.buf, _chunk_pattern
+        classes = buf.translate(_chunk_classes)
+        chunks = []
+        start = 0
+        while start < len(buf):
+            pos = classes.find(pattern, start + _chunk_min - len(pattern),
+                               start + _chunk_max)
+            if pos >= 0:
+                end = pos + len(pattern)
+            elif len(buf) - start >= _chunk_max:
+                end = start + _chunk_max
+            elif final:
+                end = len(buf)
+            else:
+                break
+            chunks.append(bytes(buf[start : end]))
+            start = end
+        del buf[ : start]
+        return chunks
+
+class ChunkStore:
+
+    def __init__(self, root, compress=None, jobs=1):
+        self.root = root
+        self.compress = compress
+        self.ext = _compressed_exts[compress] if compress else ''
+        self.lock = threading.Lock()
+        self.known = set()
+        self.pending = deque()
+        self.max_pending = 4 * jobs
+        self.executor = ThreadPoolExecutor(jobs)
+        self.stats = { 'chunks': 0, 'new': 0, 'bytes': 0, 'written': 0 }
+
+    def chunkPath(self, digest, ext=None):
+        return path.join(self.root, 'chunks', digest[ : 2],
+                         digest + (self.ext if ext is None else ext))
+
+    def put(self, data):
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        future = self.executor.submit(self.store, data)
+        self.pending.append(future)
+        return future
+
+    def store(self, data):
+        import hashlib
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            self.stats['chunks'] += 1
+            self.stats['bytes'] += len(data)
+            if digest in self.known:
+                return digest
+            self.known.add(digest)
+
+        name = self.chunkPath(digest)
+        if not path.exists(name):
+            if self.compress:
+                with _stats.phase('compress', thread_time):
+                    data = _block_compressors[self.compress](data)
+            os.makedirs(path.dirname(name), exist_ok=True)
+            temp = name + '.%d.%d' % (os.getpid(), threading.get_ident())
+            with open(temp, 'wb') as file:
+                file.write(data)
+            os.replace(temp, name)
+            with self.lock:
+                self.stats['new'] += 1
+                self.stats['written'] += len(data)
+        return digest
+
+    def get(self, digest, compress):
+        import hashlib
+        with open(self.chunkPath(digest, _compressed_exts[compress]
+                                         if compress else ''), 'rb') as file:
+            data = file.read()
+        if compress:
+            data = decompressBlock(compress, data)
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise Fatal("chunk " + digest, "checksum mismatch")
+        return data
+
+    def fetch(self, digests, compress):
+        pending = deque()
+        for digest in digests:
+            if len(pending) >= self.max_pending:
+                yield pending.popleft().result()
+            pending.append(self.executor.submit(self.get, digest, compress))
+        while pending:
+            yield pending.popleft().result()
+
+class ChunkReader:
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.pending = deque()
+        self.offset = 0
+        self.size = 0
+
+    def read(self, size=-1):
+        while size < 0 or self.size < size:
+            data = next(self.chunks, None)
+            if data is None:
+                break
+            if data:
+                self.pending.append(data)
+                self.size += len(data)
+        if size < 0 or size > self.size:
+            size = self.size
+        self.size -= size
+        # hand out slices of the queued chunks instead of re-copying a buffer
+        parts = []
+        while size > 0:
+            chunk = self.pending[0]
+            end = self.offset + size
+            if end < len(chunk):
+                parts.append(chunk[self.offset : end])
+                self.offset = end
+                break
+            parts.append(chunk[self.offset : ] if self.offset else chunk)
+            size -= len(chunk) - self.offset
+            self.pending.popleft()
+            self.offset = 0
+        return b''.join(parts)
+
+def exportManifest(name):
+    if sys.stdout.isatty():
+        raise Fatal("refusing to write a tar archive to a terminal")
 
-                    if code != 0:
-                        return False
-                    else:
-                        return True
+    try:
+        with open(name) as file:
+            header = json.loads(file.readline())
+            if header.get('format') != _manifest_format:
+                raise Fatal(shortPath(name), "not a " + __prog__ + " manifest")
+            store = _store or ChunkStore(header['store'], jobs=_jobs)
+            TestPrint(_verbose, "exporting", shortPath(name), "from",
+                      shortPath(store.root), file=sys.stderr)
+
+            tar = tarfile.open(fileobj=sys.stdout.buffer, mode='w|',
+                               format=tarfile.GNU_FORMAT)
+            for line in file:
+                record = json.loads(line)
+                tarinfo = tarfile.TarInfo(record['name'])
+                tarinfo.type = record['type'].encode()
+                for key in ('mode', 'uid', 'gid', 'uname', 'gname', 'mtime',
+                            'linkname', 'devmajor', 'devminor', 'size'):
+                    if key in record:
+                        setattr(tarinfo, key, record[key])
+                if 'chunks' in record:
+                    chunks = store.fetch(record['chunks'], header['compress'])
+                    tar.addfile(tarinfo, ChunkReader(chunks))
+                else:
+                    tar.addfile(tarinfo)
+            tar.close()
+    except (OSError, ValueError, KeyError) as e:
+        if isinstance(e, OSError):
+            raise Fatal(e.filename or name, e.strerror)
+        raise Fatal(shortPath(name), "invalid manifest")
+
+class FrameReader:
+
+    def __init__(self, file, index, offset):
+        self.file = file
+        self.compress = index['compress']
+        self.blocksize = index['blocksize']
+        self.frames = index['frames']
+        self.size = index['size']
+        self.start = self.pos = offset
+        if self.compress:
+            self.frame, skip = divmod(offset, self.blocksize)
+            self.reader = ChunkReader(self.readFrames(skip))
+
+    def readFrame(self):
+        if self.frame >= len(self.frames):
+            return b''
+        start = self.frames[self.frame]
+        end = (self.frames[self.frame + 1]
+               if self.frame + 1 < len(self.frames) else self.size)
+        self.file.seek(start)
+        self.frame += 1
+        return decompressBlock(self.compress, self.file.read(end - start))
+
+    def readFrames(self, skip):
+        yield self.readFrame()[skip : ]
+        yield from iter(self.readFrame, b'')
+
+    def read(self, size=-1):
+        if not self.compress:
+            # the file may be shared with another reader, so seek each time
+            self.file.seek(self.pos)
+            data = self.file.read(size)
+            self.pos += len(data)
+            return data
+        return self.reader.read(size)
+
+    def reaches(self, offset):
+        # whether reading on to offset costs no more than starting afresh
+        if not self.compress:
+            return offset - self.pos <= _bufsize
+        return offset // self.blocksize <= self.frame
+
+def loadIndex(archive):
+    try:
+        with open(archive + _index_ext) as file:
+            index = json.load(file)
+        if index.get('format') == _index_format and \
+           index['size'] == os.stat(archive).st_size:
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+def extractMembers(archive, names):
+    index = loadIndex(archive)
+    if index is None:
+        TestPrint(_verbose, "no index for", shortPath(archive) + ";",
+                  "reading the whole archive")
+        return scanMembers(archive, names)
+
+    members = index['members']
+    ordered = sorted(members)
+    wanted = {}
+    for name in names:
+        name = name.strip(os.sep)
+        found = name in members
+        if found:
+            wanted[name] = members[name]
+        prefix = name + os.sep
+        i = bisect_left(ordered, prefix)
+        while i < len(ordered) and ordered[i].startswith(prefix):
+            wanted[ordered[i]] = members[ordered[i]]
+            found = True
+            i += 1
+        if not found:
+            PrintError(name, "not found in archive")
+            updateStatus(1)
 
-            except IOError as e:
-                PrintError(e.filename, e.strerror)
-                updateStatus(1)
-                return False
+    # members are extracted in archive order; one stream is read on through
+    # nearby members so that each frame is decompressed once
+    done, dirs = set(), []
+    reader = tar = None
+    with open(archive, 'rb') as file:
+        for member in sorted(wanted, key=wanted.get):
+            offset = wanted[member]
+            if reader is None or not reader.reaches(offset):
+                reader = FrameReader(file, index, offset)
+                tar = tarfile.open(fileobj=reader, mode='r|')
+            tarinfo = nextMember(tar, reader, member, offset)
+            extractAt(file, index, tar, tarinfo, done, dirs)
+    setDirAttrs(dirs)
+
+def nextMember(tar, reader, name, offset):
+    while True:
+        tarinfo = tar.next()
+        if tarinfo is None or reader.start + tarinfo.offset > offset:
+            break
+        if reader.start + tarinfo.offset == offset:
+            if tarinfo.name == name:
+                return tarinfo
+            break
+    raise Fatal(shortPath(reader.file.name),
+                "index does not match the archive")
+
+def extractAt(file, index, tar, tarinfo, done, dirs):
+    done.add(tarinfo.name)
+    members = index['members']
+    if tarinfo.islnk() and tarinfo.linkname in members and \
+       tarinfo.linkname not in done:
+        # the target was not asked for; fetch it on a reader of its own
+        offset = members[tarinfo.linkname]
+        reader = FrameReader(file, index, offset)
+        target = tarfile.open(fileobj=reader, mode='r|')
+        extractAt(file, index, target,
+                  nextMember(target, reader, tarinfo.linkname, offset),
+                  done, dirs)
+    extractMember(tar, tarinfo, dirs)
+
+def scanMembers(archive, names):
+    names = [ name.strip(os.sep) for name in names ]
+    found, dirs = set(), []
+    with tarfile.open(archive) as tar:
+        for tarinfo in tar:
+            for name in names:
+                if tarinfo.name == name or \
+                   tarinfo.name.startswith(name + os.sep):
+                    found.add(name)
+                    extractMember(tar, tarinfo, dirs)
+                    break
+    setDirAttrs(dirs)
+    for name in names:
+        if name not in found:
+            PrintError(name, "not found in archive")
+            updateStatus(1)
+
+def extractMember(tar, tarinfo, dirs):
+    TestPrint(_verbose, "extracting", tarinfo.name)
+    kwargs = { 'filter': 'tar' } if hasattr(tarfile, 'tar_filter') else {}
+    try:
+        # directory attributes are set last, once their contents are in place
+        tar.extract(tarinfo, _dest, set_attrs=not tarinfo.isdir(), **kwargs)
+        if tarinfo.isdir():
+            dirs.append(tarinfo)
+    except (OSError, tarfile.TarError) as e:
+        PrintError(tarinfo.name, getattr(e, 'strerror', None) or e)
+        updateStatus(1)
+
+def setDirAttrs(dirs):
+    for tarinfo in reversed(dirs):
+        name = path.join(_dest, tarinfo.name)
+        try:
+            if os.geteuid() == 0:
+                os.chown(name, tarinfo.uid, tarinfo.gid)
+            os.chmod(name, tarinfo.mode & 0o1777)
+            os.utime(name, (tarinfo.mtime, tarinfo.mtime))
+        except OSError as e:
+            PrintError(e.filename, e.strerror)
+            updateStatus(1)
+
+def openArchive(name):
+    try:
+        with open(name, 'rb') as file:
+            magic = file.read(6)
+    except OSError as e:
+        raise Fatal(e.filename, e.strerror)
+
+    if magic.startswith(b'\x1f\x8b'):
+        method = _gzip
+    elif magic.startswith(b'BZh'):
+        method = _bzip2
+    elif magic.startswith(b'\xfd7zXZ\x00'):
+        method = _xz
+    elif magic.startswith(b'\x28\xb5\x2f\xfd'):
+        method = _zstd
+    else:
+        return open(name, 'rb'), None
+
+    # the block compressors write several streams, which tarfile's own
+    # stream mode cannot read past
+    try:
+        return decompressionModule(method).open(name), None
+    except ImportError:
+        proc = startProc([ method, '--decompress', '--stdout', '--quiet',
+                           name ], stdout=PIPE)
+        return proc.stdout, proc
+
+class Restore:
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.root = path.realpath(_dest)
+        self.made = set()
+        self.dirs = []
+        self.links = []
+        self.deleted = []
+        self.pending = deque()
+        self.max_pending = 4 * _jobs
+        self.executor = ThreadPoolExecutor(_jobs)
+        self.lock = threading.Lock()
+        self.members, self.bytes = 0, 0
+
+    def run(self):
+        TestPrint(_verbose, "restoring", shortPath(self.archive), "into",
+                  shortPath(_target), "(%d jobs)" % _jobs)
+        started = perf_counter()
+
+        file, proc = openArchive(self.archive)
+        try:
+            tar = tarfile.open(fileobj=file, mode='r|')
+            with tar:
+                for tarinfo in tar:
+                    if _abort.is_set():
+                        raise Exit(1, "aborted")
+                    self.addMember(tar, tarinfo)
+            self.drain()
+        except tarfile.TarError as e:
+            raise Fatal(shortPath(self.archive), e)
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            file.close()
+            if proc is not None:
+                waitProc(proc, ignore_code=_abort.is_set())
+
+        for tarinfo in self.links:
+            self.makeLink(tarinfo)
+        self.applyDeleted()
+        setDirAttrs(self.dirs)
+
+        elapsed = perf_counter() - started
+        ProgPrint("restored %d members, %s in %.2fs (%s/s)" %
+                  (self.members, formatSize(self.bytes), elapsed,
+                   formatSize(self.bytes / elapsed if elapsed > 0 else 0)))
+
+    def addMember(self, tar, tarinfo):
+        if tarinfo.name == _deleted_name:
+            data = tar.extractfile(tarinfo).read()
+            self.deleted += [ name for name in
+                              data.decode(tar.encoding, tar.errors).split('\0')
+                              if name ]
+            return
 
-        elif self.name != self.final_name:
-            new_path = path.join(_dest, self.final_name)
-            if not safeRemove(new_path):
-                return False
+        member = self.checkMember(tarinfo)
+        if member is None:
+            return
+        TestPrint(_verbose, "restoring", member.name)
+        self.members += 1
+        name = path.join(_dest, member.name)
+
+        if member.isdir():
+            self.makeDirs(name)
+            self.dirs.append(member)
+            return
+        self.makeDirs(path.dirname(name))
+
+        if member.islnk():
+            if self.checkMember(tarfile.TarInfo(member.linkname)) is not None:
+                self.links.append(member)
+        elif member.isreg() and member.size > _bufsize:
+            self.bytes += member.size
+            self.writeLarge(tar.extractfile(tarinfo), member, name)
+        elif member.isreg():
+            self.bytes += member.size
+            data = tar.extractfile(tarinfo).read()
+            self.submit(self.writeFile, member, name, data)
+        else:
+            self.submit(self.makeSpecial, member, name)
 
+    def checkMember(self, tarinfo):
+        try:
+            if hasattr(tarfile, 'tar_filter'):
+                return tarfile.tar_filter(tarinfo, self.root)
+            name = path.normpath(tarinfo.name)
+            if path.isabs(name) or name.split(os.sep)[0] == os.pardir:
+                raise tarfile.TarError("member is outside the destination")
+            return tarinfo
+        except tarfile.TarError as e:
+            PrintError(tarinfo.name, e)
+            updateStatus(1)
+            return None
+
+    def makeDirs(self, name):
+        if name in self.made:
+            return
+        try:
+            if not path.isdir(name):
+                self.unlink(name)
+                os.makedirs(name, exist_ok=True)
+            self.made.add(name)
+        except OSError as e:
+            self.failed(e)
+
+    def submit(self, func, *args):
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        future = self.executor.submit(func, *args)
+        self.pending.append(future)
+        return future
+
+    def drain(self):
+        while self.pending:
+            self.pending.popleft().result()
+
+    def writeFile(self, tarinfo, name, data):
+        try:
+            fd = self.create(name, tarinfo)
             try:
-                os.rename(self.path, new_path)
-                self.path = new_path
-                self.name = self.final_name
-                return True
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view) : ]
+                self.setAttrs(fd, name, tarinfo)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            self.failed(e)
+
+    def writeLarge(self, file, tarinfo, name):
+        try:
+            fd = self.create(name, tarinfo)
+        except OSError as e:
+            self.failed(e)
+            return
+
+        writes, offset = [], 0
+        while True:
+            data = file.read(_bufsize)
+            if not data:
+                break
+            writes.append(self.submit(self.writeAt, fd, data, offset))
+            offset += len(data)
+        self.submit(self.finishLarge, fd, name, tarinfo, writes)
+
+    def writeAt(self, fd, data, offset):
+        # errors are returned for finishLarge to report, not raised through
+        # submit() or drain()
+        try:
+            view = memoryview(data)
+            while view:
+                count = os.pwrite(fd, view, offset)
+                view, offset = view[count : ], offset + count
+        except OSError as e:
+            return e
+        return None
 
-            except OSError:
+    def finishLarge(self, fd, name, tarinfo, writes):
+        try:
+            for future in writes:
+                error = future.result()
+                if error is not None:
+                    error.filename = name
+                    raise error
+            self.setAttrs(fd, name, tarinfo)
+        except OSError as e:
+            self.failed(e)
+        finally:
+            os.close(fd)
+
+    def create(self, name, tarinfo):
+        self.unlink(name)
+        return os.open(name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                             os.O_NOFOLLOW | os.O_CLOEXEC, 0o600)
+
+    def unlink(self, name):
+        try:
+            if not stat.S_ISDIR(os.lstat(name).st_mode):
+                os.unlink(name)
+        except FileNotFoundError:
+            pass
+
+    def makeSpecial(self, tarinfo, name):
+        try:
+            self.unlink(name)
+            if tarinfo.issym():
+                os.symlink(tarinfo.linkname, name)
+            elif tarinfo.isfifo():
+                os.mkfifo(name, 0o600)
+            elif tarinfo.ischr() or tarinfo.isblk():
+                os.mknod(name, 0o600 | (stat.S_IFCHR if tarinfo.ischr()
+                                                     else stat.S_IFBLK),
+                         os.makedev(tarinfo.devmajor, tarinfo.devminor))
+            else:
+                PrintError(tarinfo.name, "unsupported member type")
                 updateStatus(1)
-                return False
+                return
+            self.setAttrs(None, name, tarinfo)
+        except OSError as e:
+            self.failed(e)
+
+    def makeLink(self, tarinfo):
+        name = path.join(_dest, tarinfo.name)
+        try:
+            self.unlink(name)
+            os.link(path.join(_dest, tarinfo.linkname), name,
+                    follow_symlinks=False)
+        except OSError as e:
+            self.failed(e)
+
+    def setAttrs(self, fd, name, tarinfo):
+        link = tarinfo.issym()
+        if os.geteuid() == 0:
+            if fd is not None:
+                os.fchown(fd, tarinfo.uid, tarinfo.gid)
+            else:
+                os.chown(name, tarinfo.uid, tarinfo.gid, follow_symlinks=False)
+        if fd is not None:
+            os.fchmod(fd, tarinfo.mode)
+        elif not link:
+            os.chmod(name, tarinfo.mode)
+        if fd is not None:
+            os.utime(fd, (tarinfo.mtime, tarinfo.mtime))
+        elif not link or os.utime in os.supports_follow_symlinks:
+            os.utime(name, (tarinfo.mtime, tarinfo.mtime),
+                     follow_symlinks=not link)
+
+    def applyDeleted(self):
+        for name in self.deleted:
+            tarinfo = tarfile.TarInfo(name)
+            member = self.checkMember(tarinfo)
+            if member is None:
+                continue
+            TestPrint(_verbose, "deleting", member.name)
+            count, size, errors = removeTree(path.join(_dest, member.name),
+                                               removeFailed)
+            if errors:
+                updateStatus(1)
+
+    def failed(self, e):
+        PrintError(e.filename and shortPath(e.filename), e.strerror)
+        updateStatus(1)
+
+class HashingFile:
+
+    def __init__(self, file):
+        self.file = file
+        self.digest = _sha256()
 
+    def write(self, data):
+        self.digest.update(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+def contentKey(tarinfo):
+    return (tarinfo.size, tarinfo.mode, tarinfo.uid, tarinfo.gid,
+            tarinfo.mtime)
+
+def copyData(src, dst, errors):
+    # runs on its own thread: a failed write is left in errors for the
+    # caller, and the rest is read and dropped so the compressor can finish
+    while True:
+        data = src.read(_bufsize)
+        if not data:
+            break
+        if not errors:
+            try:
+                dst.write(data)
+            except OSError as e:
+                errors.append(e)
+
+def hashFile(name):
+    with open(name, 'rb') as file:
+        digest = _sha256()
+        while True:
+            data = file.read(_bufsize)
+            if not data:
+                return digest.hexdigest()
+            digest.update(data)
+
+def loadSums(archive):
+    try:
+        with open(archive + _sums_ext) as file:
+            sums = json.load(file)
+        if sums.get('format') == _sums_format:
+            return sums
+        PrintError(shortPath(archive + _sums_ext), "unknown format")
+    except (OSError, ValueError) as e:
+        PrintError(shortPath(archive + _sums_ext),
+                   getattr(e, 'strerror', None) or "invalid checksums")
+    updateStatus(1)
+    return None
+
+def verifyArchive(archive):
+    sums = loadSums(archive)
+    if sums is None:
+        return
+    TestPrint(_verbose, "verifying", shortPath(archive),
+              "against its source files (%d jobs)" % _jobs if _live else
+              "(%d jobs)" % _jobs)
+
+    with ThreadPoolExecutor(_jobs) as executor:
+        if _live:
+            bad = verifyLive(executor, sums)
         else:
+            bad = verifyStream(executor, archive, sums)
+
+    ProgPrint("%s: %d members checked, %d bad" %
+              (shortPath(archive), len(sums['members']), bad))
+    if bad:
+        updateStatus(1)
+
+def verifyLive(executor, sums):
+    def check(item):
+        name, (digest, source) = item
+        if source is None:
             return True
+        try:
+            if hashFile(source) == digest:
+                return True
+            PrintError(name, shortPath(source), "changed since it was archived")
+        except OSError as e:
+            PrintError(shortPath(source), e.strerror)
+        return False
 
-class Tempdir(FileCollection):
+    return sum(not ok for ok in executor.map(check, sums['members'].items()))
 
-    def prep(self):
-        if not super().prep():
-            return False
+def verifyStream(executor, archive, sums):
+    def check(name, data, digest):
+        if _sha256(data).hexdigest() == digest:
+            return True
+        PrintError(name, "checksum mismatch")
+        return False
 
+    archive_check = executor.submit(hashFile, archive)
+    members = sums['members']
+    seen, pending, bad = set(), deque(), 0
+
+    file, proc = openArchive(archive)
+    try:
+        with tarfile.open(fileobj=file, mode='r|') as tar:
+            for tarinfo in tar:
+                if not tarinfo.isreg():
+                    continue
+                seen.add(tarinfo.name)
+                if tarinfo.name not in members:
+                    PrintError(tarinfo.name, "no checksum")
+                    bad += 1
+                    continue
+                data = tar.extractfile(tarinfo)
+                digest = members[tarinfo.name][0]
+                if tarinfo.size > _bufsize:
+                    # large members are hashed here, as they are read
+                    hash = _sha256()
+                    for block in iter(lambda: data.read(_bufsize), b''):
+                        hash.update(block)
+                    if hash.hexdigest() != digest:
+                        PrintError(tarinfo.name, "checksum mismatch")
+                        bad += 1
+                    continue
+                if len(pending) >= 4 * _jobs:
+                    bad += not pending.popleft().result()
+                pending.append(executor.submit(check, tarinfo.name,
+                                               data.read(), digest))
+    except (OSError, EOFError, tarfile.TarError) as e:
+        PrintError(shortPath(archive), getattr(e, 'strerror', None) or e)
+        bad += 1
+    finally:
+        file.close()
+        if proc is not None:
+            waitProc(proc)
+
+    bad += sum(not future.result() for future in pending)
+    for name in members:
+        if name not in seen:
+            PrintError(name, "missing from the archive")
+            bad += 1
+
+    if archive_check.result() != sums['sha256']:
+        PrintError(shortPath(archive), "archive checksum mismatch")
+        bad += 1
+    return bad
+
+class Progress:
+
+    def __init__(self, interval, show, file):
+        self.interval = interval
+        self.show = show
+        self.file = file
+        self.lock = threading.Lock()
+        self.active = {}
+        self.finished = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.report(final=True)
+
+    def add(self, archive):
+        with self.lock:
+            self.active[archive] = perf_counter()
+
+    def remove(self, archive):
+        with self.lock:
+            started = self.active.pop(archive, None)
+            if started is None:
+                return
+            record = self.record(archive, started)
+            record['done'] = True
+            self.finished.append(record)
+        if self.show:
+            self.printRecord(record)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self, final=False):
+        with self.lock:
+            records = [ self.record(archive, started)
+                        for archive, started in self.active.items() ]
+            finished = list(self.finished)
+        if self.show and not final:
+            for record in records:
+                self.printRecord(record)
+        if self.file:
+            self.save(finished + records, final)
+
+    def record(self, archive, started):
+        read, written, members = archive.progress()
+        scanned, total = archive.position(), archive.estimate()
+        elapsed = perf_counter() - started
+        rate = read / elapsed if elapsed > 0 else 0
+        scan_rate = scanned / elapsed if elapsed > 0 else 0
+        return {
+            'name':     archive.name,
+            'total':    total,
+            'scanned':  scanned,
+            'read':     read,
+            'written':  written,
+            'members':  members,
+            'elapsed':  elapsed,
+            'rate':     rate,
+            'files_per_second': members / elapsed if elapsed > 0 else 0,
+            'ratio':    read / written if written else None,
+            'eta':      (max(total - scanned, 0) / scan_rate
+                         if total is not None and scan_rate > 0 else None),
+            'done':     False,
+        }
+
+    def printRecord(self, record):
+        if record['done']:
+            status = "done in " + formatTime(record['elapsed'])
+        elif record['eta'] is not None:
+            status = "ETA " + formatTime(record['eta'])
+        else:
+            status = "ETA unknown"
+        if record['done']:
+            percent = '100%'
+        elif record['total']:
+            percent = '%d%%' % min(100 * record['scanned'] / record['total'],
+                                   99)
+        else:
+            percent = '-'
+        total = record['total']
+        ProgPrint("%s: %s of %s scanned (%s), %s read, %s written, "
+                  "%d files (%.0f/s), %s/s, ratio %s, %s" %
+                  (record['name'], formatSize(record['scanned']),
+                   '~' + formatSize(total) if total is not None else '?',
+                   percent,
+                   formatSize(record['read']),
+                   formatSize(record['written'] or 0), record['members'],
+                   record['files_per_second'], formatSize(record['rate']),
+                   '%.2f' % record['ratio'] if record['ratio'] else '-',
+                   status), file=sys.stderr)
+
+    def save(self, records, final):
+        data = {
+            'time':     time(),
+            'pid':      os.getpid(),
+            'running':  not final,
+            'archives': records,
+        }
         try:
-            os.mkdir(self.path)
-            self.status = True
+            temp = self.file + '.%d' % os.getpid()
+            with open(temp, 'w') as f:
+                json.dump(data, f, indent=2)
+            os.replace(temp, self.file)
         except OSError as e:
-            PrintError("error creating temporary directory",
-                       e.filename, e.strerror)
-            updateStatus(1)
-            self.status = False
-
-        return self.status
+            PrintError("error saving progress", e.filename, e.strerror)
 
-    def checkedCommit(self):
-        TestPrint(_verbose, "copying files to", shortPath(self.path))
+def formatSize(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if size < 1024 or unit == 'TiB':
+            break
+        size /= 1024
+    return ('%d %s' if unit == 'B' else '%.1f %s') % (size, unit)
 
-        for base, follow in self.queues.keys():
-            os.chdir(base)
+def formatTime(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
 
-            code = runProc( _cp_default + [ self.path ] +
-                            ( [ '--dereference' ] if follow else [] ) +
-                            self.queues[(base, follow)] )[2]
-            if code != 0:
-                return False
 
-        return True
+def archiveRecord(archive, done):
+    try:
+        size = os.stat(archive.path).st_size if done else None
+    except OSError:
+        size = None
+    queues = archive.stats['queues'] + archive.stats['tempdirs']
+    record = {
+        'name':     archive.name,
+        'path':     archive.path,
+        'done':     done,
+        'size':     size,
+        'members':  sum(q['members'] for q in queues),
+        'bytes':    sum(q['bytes'] for q in queues),
+        'compress': _compress,
+    }
+    record.update(archive.stats)
+    return record
 
 
 def parseLine(line):
@@ -399,11 +1883,12 @@ def parseLine(line):
             break
     else:
         leading_flags = ''
+    tempdir = None
     if '#' in line:
         comment = _re_comments.sub(r'\g<comment>', line, 1).lstrip('#').lstrip()
         match = _re_tempdir.match(comment)
         if match:
-            setTempdir(match.group('tempdir'))
+            tempdir = match.group('tempdir')
         line = _re_comments.sub(r'\g<repl>', line, 1).rstrip()
     line = path.expandvars(path.expanduser(line))
     if '"' in line:
@@ -411,15 +1896,20 @@ def parseLine(line):
         if _re_bare_quote.search(line):
             PrintError("syntax", "unterminated quote", line)
             updateStatus(1)
-            return ''
+            return leading_flags, '', tempdir
     if '\\' in line:
         line = _re_escaped.sub(r'\g<repl>', line)
     if os.sep * 2 in line:
         line = _re_repeated_sep.sub(os.sep, line)
-    return leading_flags, _re_repeated_relative.sub(r'\g<repl>', line)
+    return (leading_flags, _re_repeated_relative.sub(r'\g<repl>', line),
+            tempdir)
 
-def processLine(line):
-    flags, pattern = parseLine(line)
+def compileLine(plan, line, filedir):
+    plan.addEnv(_re_leading_flags.match(line).group('line'))
+    flags, pattern, tempdir = parseLine(line)
+
+    if tempdir:
+        plan.ops.append([ 'tempdir', tempdir ])
 
     if not pattern:
         return False
@@ -428,14 +1918,16 @@ def processLine(line):
     copy = _copy_chr in flags
 
     if link:
+        link_path = path.join(filedir, pattern)
+        links = _glob(_dircache, link_path)
+        plan.globs.append([ link_path, links[:] ])
+        if not links:
+            links.append(link_path)
         try:
-            link_path = path.join(_filedir, pattern)
-            links = _glob(link_path)
-            if not links:
-                links.append(link_path)
             for link in links:
                 with open(link) as file:
-                    readLines(file, path.dirname(link))
+                    plan.addFile(link)
+                    compileLines(plan, file, path.dirname(link))
             return True
         except IOError as e:
             PrintError(e.filename, e.strerror)
@@ -458,38 +1950,43 @@ def processLine(line):
         glob_pat = ''
 
     implied_pat = max(implied_pat, glob_pat, key=len)
-    abspath = path.abspath(pattern[ : -len(implied_pat)])
 
-    if path.isdir(abspath):
-        os.chdir(abspath)
-    else:
+    plan.ops.append([ 'copy' if copy else 'add', pattern,
+                      pattern[ : -len(implied_pat)], implied_pat ])
+    return True
+
+def expandPattern(copy, pattern, base, implied_pat, tempdir):
+    abspath = path.abspath(base)
+
+    if not _dircache.isdir(abspath):
         PrintError("no matches", pattern)
         updateStatus(1)
-        return False
+        return None
 
     if not implied_pat:
         implied_pat = '.'
 
-    globList = _glob(implied_pat)
+    globList = _glob(_dircache, implied_pat, abspath)
 
     if not globList:
         PrintError("no matches", pattern)
         updateStatus(1)
-        return False
+        return None
 
     if _deref == 'L':
         if _verbose:
             for entry in globList:
-                printEntry(entry, copy, follow='L')
+                printEntry(entry, abspath, copy and tempdir, follow='L')
         fileList, derefList = [], globList
     else:
         fileList, derefList = [], []
         for entry in globList:
-            if _deref == 'H' and path.islink(entry) or entry.endswith(os.sep):
-                if path.isfile(entry):
+            if _deref == 'H' and _dircache.islink(entry, abspath) or \
+               entry.endswith(os.sep):
+                if _dircache.isfile(entry, abspath):
                     derefList.append(entry)
-                elif path.isdir(entry):
-                    contents = _glob(path.join(entry, '*'))
+                elif _dircache.isdir(entry, abspath):
+                    contents = _glob(_dircache, path.join(entry, '*'), abspath)
                     if contents:
                         fileList += contents
                     else:
@@ -497,136 +1994,377 @@ def processLine(line):
                 else:
                     fileList.append(entry)
                 if _verbose:
-                    printEntry(entry, copy,
-                               follow=('H' if path.islink(entry.rstrip(os.sep))
+                    printEntry(entry, abspath, copy and tempdir,
+                               follow=('H' if _dircache.islink(
+                                                entry.rstrip(os.sep), abspath)
                                            else False))
             else:
                 if _verbose:
-                    printEntry(entry, copy)
+                    printEntry(entry, abspath, copy and tempdir)
                 fileList.append(entry)
 
-    if copy:
-        _tempdir.add(fileList, abspath)
-        _tempdir.add(derefList, abspath, follow=True)
-    else:
-        _archive.add(fileList, abspath)
-        _archive.add(derefList, abspath, follow=True)
-
-    return True
+    return abspath, fileList, derefList
 
+def expandOp(op, tempdir):
+    try:
+        return expandPattern(op[0] == 'copy', *op[1:], tempdir)
+    except OSError as e:
+        PrintError(e.filename, e.strerror)
+        updateStatus(1)
+        return None
 
-def printEntry(entry, copy, follow=False):
+def printEntry(entry, root, tempdir, follow=False):
     s = '_'
-    print("[%c%c%c] " % ('D' if path.isdir(entry) else s,
-                         'C' if copy else s,
+    print("[%c%c%c] " % ('D' if _dircache.isdir(entry, root) else s,
+                         'C' if tempdir else s,
                          follow if follow else s),
-          (_tempdir.name + os.sep if copy else '') + entry)
-
-def setTempdir(name):
-    global _tempdir
-
-    for td in _tempdirs:
-        if td.name == name:
-            _tempdir = td
-            return
-    _tempdir = Tempdir(name)
-    _tempdirs.add(_tempdir)
-
-def readLines(file, filedir):
-    global _filedir
+          (tempdir + os.sep if tempdir else '') + entry)
 
-    saved_filedir = _filedir
-    _filedir = filedir
-
-    for line in file:
+def saveStats(status):
+    try:
+        _stats.save(_stats_file, program=__prog__, version=__version__,
+                    status=status, errors=_num_errors)
+    except OSError as e:
+        PrintError("error saving statistics", e.filename, e.strerror)
+
+def readPlan(file, filedir):
+    cache = None
+    if _cache:
+        cache = planPath(_cache, __prog__, file.name, _rundir)
+        plan = Plan.load(cache, __version__)
+        if plan is not None and plan.isCurrent(_dircache, _glob):
+            TestPrint(_verbose, "using compiled plan", shortPath(cache))
+            return plan
+
+    plan = Plan(__version__)
+    if cache:
+        plan.addFile(file.name)
+
+    num_errors = _num_errors
+    compileLines(plan, file, filedir)
+    if cache and _num_errors == num_errors:
         try:
-            processLine(line.strip())
+            plan.save(cache)
         except OSError as e:
-            PrintError(e.filename, e.strerror)
-            updateStatus(1)
-        finally:
-            os.chdir(_rundir)
+            PrintError("error saving compiled plan", e.filename, e.strerror)
 
-    _filedir = saved_filedir
+    return plan
 
-def readFile(file, filedir, basename):
-    global _archive
+def compileLines(plan, file, filedir):
+    for line in file:
+        compileLine(plan, line.strip(), filedir)
+
+def runPlan(archive, plan):
+    tempdirs, tempdir = [], archive.tempdir.name
+    for op in plan.ops:
+        if op[0] == 'tempdir':
+            tempdir = op[1]
+        tempdirs.append(tempdir)
+
+    patterns = sum(op[0] != 'tempdir' for op in plan.ops)
+    if _jobs < 2 or patterns < 2:
+        results = (None if op[0] == 'tempdir' else expandOp(op, tempdir)
+                   for op, tempdir in zip(plan.ops, tempdirs))
+        applyPlan(archive, plan, results)
+        return
+
+    saved = captureOutput()
+    executor = ThreadPoolExecutor(min(_jobs, patterns))
+    try:
+        futures = [ None if op[0] == 'tempdir' else
+                    executor.submit(capture, expandOp, op, tempdir)
+                    for op, tempdir in zip(plan.ops, tempdirs) ]
+        applyPlan(archive, plan, (collect(future) for future in futures))
+    finally:
+        executor.shutdown(cancel_futures=True)
+        restoreOutput(saved)
+
+def applyPlan(archive, plan, results):
+    for op, result in zip(plan.ops, results):
+        if op[0] == 'tempdir':
+            archive.setTempdir(op[1])
+        elif result is not None:
+            abspath, fileList, derefList = result
+            queue = archive.tempdir if op[0] == 'copy' else archive
+            queue.add(fileList, abspath)
+            queue.add(derefList, abspath, follow=True)
 
+def readFile(file, filedir, basename):
     format = strftime(path.expandvars(_format))
     format = format.replace(_format_token, basename).replace(os.sep, '_')
 
     ext = _re_archive_ext.search(format)
-    _archive = Archive(_re_archive_ext.sub('', format),
-                       ext.group() if ext else None)
+    archive = (StoreArchive if _store else Archive)(
+                      _re_archive_ext.sub('', format),
+                      ext.group() if ext else None)
 
-    setTempdir(basename)
+    if _snapshots is not None:
+        archive.snapshot = {}
+        archive.last_snapshot = _snapshots.get(basename, {})
 
-    readLines(file, filedir)
+    archive.setTempdir(basename)
+
+    with _stats.phase('parse'):
+        plan = readPlan(file, filedir)
+    with _stats.phase('expand'):
+        runPlan(archive, plan)
 
     if not _simulate:
-        if all(td.commit() for td in _tempdirs):
-            _archive.add([ td.name for td in _tempdirs if td.status is True ],
-                         _dest)
-            if _archive.commit() and _archive.compressAndReplace():
-                TestPrint(_verbose, "done:", _archive.name)
-                _archive = None
+        with _status_lock:
+            lock = _path_locks.setdefault(archive.path, threading.Lock())
+        with lock:
+            _active.add(archive)
+            with _stats.phase('archive'):
+                done = archive.commit()
+            if done:
+                TestPrint(_verbose, "done:", archive.name)
+                if _snapshots is not None:
+                    _snapshots[basename] = archive.snapshot
+            else:
+                archive.remove()
+            _active.discard(archive)
+        _stats.add('archives', archiveRecord(archive, done))
     else:
-        if _verbose and (_archive.queues or any(td.queues for td in _tempdirs)):
-            ProgPrint(_archive.name if _compress else _archive.final_name,
-                      "will be created in", shortPath(_target))
+        if _verbose and not archive.isEmpty():
+            ProgPrint(archive.name, "will be created in", shortPath(_target))
             if _compress:
-                ProgPrint("to be compressed using", _compress[0],
-                          "to", _archive.final_name)
+                ProgPrint("to be compressed using", _compress)
 
-    cleanup()
-    _tempdirs.clear()
+def readArg(arg, continued):
+    try:
+        with open(arg) as file:
+            if _verbose:
+                TestPrint(continued)
+                ProgPrint("reading from", shortPath(arg))
+                ProgPrint("adding entries to queue")
+                ProgPrint("D [directory], C [copy], [LH] [dereference]")
+
+            readFile( file, path.dirname(arg),
+                      path.splitext(path.basename(arg)) [0] )
+            return True
+    except IOError as e:
+        PrintError(e.filename, e.strerror)
+        updateStatus(1)
+        return False
 
-def cleanup():
-    if _archive is not None:
-        _archive.remove()
-    for td in _tempdirs:
-        td.remove()
+def capture(func, *args):
+    _output.output = []
+    try:
+        return func(*args), _output.output, None
+    except BaseException as e:
+        return None, _output.output, e
+    finally:
+        _output.output = None
+
+def collect(future):
+    if future is None:
+        return None
+    result, output, error = future.result()
+    captured = getattr(_output, 'output', None)
+    for file, s in output:
+        if captured is None:
+            file.write(s)
+        else:
+            captured.append((file, s))
+    if error is not None:
+        raise error
+    return result
+
+def captureOutput():
+    if isinstance(sys.stdout, ThreadOutput):
+        return None
+    saved = sys.stdout, sys.stderr
+    sys.stdout = ThreadOutput(saved[0], _output)
+    sys.stderr = ThreadOutput(saved[1], _output)
+    return saved
+
+def restoreOutput(saved):
+    if saved is not None:
+        sys.stdout, sys.stderr = saved
+
+def readArgs(args):
+    if _parallel < 2 or len(args) < 2:
+        continued = False
+        for arg in args:
+            continued = readArg(arg, continued) or continued
+        return continued
 
-def extglob(pat):
-    out = runProc( [ _extglob, pat ],
-                   stdout=PIPE, stderr=PIPE, ignore_code=True )[0]
-    return [ line for line in out.split('\n') if line ]
+    saved = captureOutput()
+    executor = ThreadPoolExecutor(min(_parallel, len(args)))
+    try:
+        TestPrint(_verbose, "reading", len(args), "files,",
+                  min(_parallel, len(args)), "at a time")
+        futures = [ executor.submit(capture, readArg, arg, i > 0)
+                    for i, arg in enumerate(args) ]
+        continued = False
+        for future in futures:
+            continued = collect(future) or continued
+        return continued
+    except BaseException:
+        _abort.set()
+        raise
+    finally:
+        executor.shutdown(cancel_futures=True)
+        restoreOutput(saved)
+
+def loadSnapshots():
+    try:
+        with open(_incremental) as file:
+            data = json.load(file)
+    except FileNotFoundError:
+        return {}
+    except (IOError, ValueError) as e:
+        raise Fatal(_incremental, getattr(e, 'strerror', None) or
+                                  "invalid snapshot file")
+
+    if data.get('format') != _snapshot_format:
+        raise Fatal(_incremental, "unsupported snapshot format")
+    return data['archives']
+
+def saveSnapshots():
+    data = {
+        'format':   _snapshot_format,
+        'archives': _snapshots,
+    }
+    try:
+        temp = _incremental + '.%d' % os.getpid()
+        with open(temp, 'w') as file:
+            json.dump(data, file, separators=(',', ':'))
+        os.replace(temp, _incremental)
+    except OSError as e:
+        PrintError("error saving snapshot", e.filename, e.strerror)
+        updateStatus(1)
 
+def cleanup():
+    for archive in list(_active):
+        archive.remove()
+
+def blockCompressor(method):
+    if method == _gzip:
+        import zlib, struct
+        def compress(data):
+            header = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+            trailer = struct.pack('<LL', zlib.crc32(data),
+                                  len(data) & 0xffffffff)
+            deflate = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+            return header + deflate.compress(data) + deflate.flush() + trailer
+    elif method == _bzip2:
+        import bz2
+        def compress(data):
+            return bz2.compress(data, 9)
+    elif method == _xz:
+        import lzma
+        def compress(data):
+            return lzma.compress(data, lzma.FORMAT_XZ)
+    else:
+        raise ImportError(method)
+    return compress
+
+def decompressionModule(method):
+    if method == _gzip:
+        import gzip
+        return gzip
+    elif method == _bzip2:
+        import bz2
+        return bz2
+    elif method == _xz:
+        import lzma
+        return lzma
+    raise ImportError(method)
+
+def decompressBlock(method, data):
+    try:
+        return decompressionModule(method).decompress(data)
+    except ImportError:
+        pass
+    out, err, code = runProc([ method, '--decompress', '--stdout', '--quiet' ],
+                             stdout=PIPE, input=data, text=False,
+                             ignore_code=True)
+    if code != 0:
+        raise Fatal(method, "cannot decompress data")
+    return out
 
 def updateStatus(code):
     global _status, _num_errors
-    if code == 0:
-        _status = 0
-        _num_errors = 0
-    else:
-        _status = max(_status, code)
-        _num_errors += 1
+    with _status_lock:
+        if code == 0:
+            _status = 0
+            _num_errors = 0
+        else:
+            _status = max(_status, code)
+            _num_errors += 1
 
 def instantiateGlobals():
-    global _rundir, _filedir
+    global _rundir
     global _children
-    global _tempdirs
-    global _archive, _tempdir
-    global _extglob
-    global _cp_default
-    global _tar_default
+    global _active
+    global _path_locks
+    global _status_lock, _prompt_lock
+    global _abort
+    global _output
+    global _stats, _stats_file
+    global _progress
+    global _dircache
+    global _umask
+    global _unames, _gnames
+    global _bufsize
     global _tar_ext
-    global _gzip, _bzip2
+    global _deleted_name
+    global _snapshot_format
+    global _gzip, _bzip2, _xz, _zstd
     global _compressed_exts
-    _rundir, _filedir = os.getcwd(), None
+    global _block_sizes
+    global _manifest_ext, _manifest_format
+    global _index_ext, _index_format
+    global _sums_ext, _sums_format, _sha256
+    global _chunk_min, _chunk_max, _chunk_pattern, _chunk_classes
+    _rundir = os.getcwd()
     _children = set()
-    _tempdirs = set()
-    _archive, _tempdir = None, None
-    _extglob = "extglob"
-    _cp_default = [ 'cp', '-a', '--parents' ]
-    _tar_default = [ 'tar' ]
+    _active = set()
+    _path_locks = {}
+    _status_lock = threading.Lock()
+    _prompt_lock = threading.Lock()
+    _abort = threading.Event()
+    _output = threading.local()
+    _stats, _stats_file = Stats('archives'), None
+    _progress = None
+    _dircache = DirCache()
+    _umask = os.umask(0)
+    os.umask(_umask)
+    _unames, _gnames = {}, {}
+    _bufsize = 1024 * 1024
     _tar_ext = '.tar'
+    _deleted_name = '.tarf-deleted'
+    _snapshot_format = 1
     _gzip = 'gzip'
     _bzip2 = 'bzip2'
+    _xz = 'xz'
+    _zstd = 'zstd'
     _compressed_exts = {
         _gzip:  '.gz',
         _bzip2: '.bz2',
+        _xz:    '.xz',
+        _zstd:  '.zst',
+    }
+    _block_sizes = {
+        _gzip:  1024 * 1024,
+        _bzip2: 900 * 1000,
+        _xz:    8 * 1024 * 1024,
     }
+    import hashlib
+    _manifest_ext = '.manifest'
+    _manifest_format = 1
+    _index_ext = '.idx'
+    _index_format = 1
+    _sums_ext = '.sums'
+    _sums_format = 1
+    _sha256 = hashlib.sha256
+    # content-defined chunks end where the last 8 bytes, each mapped to one
+    # of 4 classes, spell out a fixed sequence (once every 64 KiB on average)
+    _chunk_min, _chunk_max = 16 * 1024, 256 * 1024
+    _chunk_pattern = bytes((0, 1, 2, 3, 3, 2, 1, 0))
+    _chunk_classes = bytes(hashlib.sha256(bytes((i,))).digest()[0] & 3
+                           for i in range(256))
 
     global _relative_pat
     global _format_token
@@ -673,11 +2411,13 @@ def instantiateGlobals():
                                r'[*?+@!]\([^' + s + r']+\)'
                                r').*$')
     _re_home = re.compile(r'^' + path.expanduser('~'))
-    _re_archive_ext = re.compile('\\' + _tar_ext + r'(?:\.(?:[zZ]|gz|bz2?))?$|'
-                                 r'\.t(?:gz|bz2?)$')
+    _re_archive_ext = re.compile('\\' + _tar_ext + r'(?:\.(?:[zZ]|gz|bz2?|xz|zst))?$|'
+                                 r'\.t(?:gz|bz2?|xz|zst)$')
 
 def parseOptions(argv):
     global _target
+    global _cache
+    global _incremental, _snapshots
     global _dest
     global _format
     global _deref
@@ -685,8 +2425,17 @@ def parseOptions(argv):
     global _verbose
     global _simulate
     global _glob
-    global _compress
-    global _tar_create, _tar_append
+    global _compress, _compress_cmd
+    global _block_compressors
+    global _jobs
+    global _parallel
+    global _stats_file
+    global _progress
+    global _store, _export
+    global _seekable, _extract
+    global _restore
+    global _checksums, _verify, _live
+    global _dedupe
 
     from optparse import OptionParser, OptParseError
     class OptParser(OptionParser):
@@ -710,6 +2459,61 @@ def parseOptions(argv):
                                'performed; the pattern "%default" will be '
                                'replaced with the name of the corresponding '
                                'input file, without the suffix')
+        parser.add_option("--cache", metavar="DIR",
+                          help='save compiled input files in DIR and reuse '
+                               'them while the files and the files they '
+                               'include are unchanged')
+        parser.add_option("--stats", metavar="FILE",
+                          help='write the time spent in each phase, the '
+                               'number of files and bytes archived and the '
+                               'child processes run to FILE as JSON')
+        parser.add_option("--progress", metavar="SECONDS", type="float",
+                          help='report the progress of each archive on '
+                               'standard error every SECONDS seconds')
+        parser.add_option("--progress-file", metavar="FILE",
+                          help='write the progress of each archive to FILE as '
+                               'JSON (every 5 seconds unless --progress is '
+                               'given)')
+        parser.add_option("-g", "--incremental", metavar="SNAPSHOT",
+                          help='create incremental archives that only contain '
+                               'files changed since the last run, using and '
+                               'updating the snapshot file SNAPSHOT')
+        parser.add_option("--store", metavar="DIR",
+                          help='instead of an archive, write a manifest that '
+                               'refers to content-defined chunks of the files, '
+                               'which are stored once in DIR')
+        parser.add_option("--export", metavar="MANIFEST",
+                          help='write a tar archive made from MANIFEST and the '
+                               'chunks it refers to to standard output')
+        parser.add_option("--seekable", default=False, action="store_true",
+                          help='write an index of the members of each '
+                               'archive next to it, with a "' + _index_ext +
+                               '" suffix, so that they can be extracted '
+                               'without reading the whole archive')
+        parser.add_option("--extract", default=False, action="store_true",
+                          help='extract the given members (and anything '
+                               'under them) from the archive given last on '
+                               'the command line into the target directory')
+        parser.add_option("--restore", metavar="ARCHIVE",
+                          help='extract everything in ARCHIVE into the target '
+                               'directory, writing files on --jobs threads, '
+                               'and apply the list of deleted files of '
+                               'incremental archives')
+        parser.add_option("--checksums", default=False, action="store_true",
+                          help='write the SHA-256 of each archive and of its '
+                               'members next to it, with a "' + _sums_ext +
+                               '" suffix')
+        parser.add_option("--dedupe", default=False, action="store_true",
+                          help='store files with the same contents and '
+                               'attributes as a file already in the archive '
+                               'as hard links to it; they are restored as '
+                               'one shared inode')
+        parser.add_option("--verify", default=False, action="store_true",
+                          help='check the archives given on the command line '
+                               'against their checksums, on --jobs threads')
+        parser.add_option("--live", default=False, action="store_true",
+                          help='with --verify, check the files the archives '
+                               'were made from instead of the archives')
         parser.add_option("-L", "--dereference", dest="dereference",
                           action="store_const", const="L",
                           help='follow all symbolic links')
@@ -724,14 +2528,29 @@ def parseOptions(argv):
         parser.add_option("-n", "--simulate", default=False, action="store_true",
                           help="read input files, but don't write to disk")
         parser.add_option("-e", "--extglob", default=False, action="store_true",
-                          help="enable bash extended globbing (requires "
-                               "`" + _extglob + "' in $PATH)")
+                          help='enable bash extended globbing (as with the '
+                               '"extglob" and "dotglob" shell options)')
         parser.add_option("-z", "--"+_gzip, dest="compress",
                           action="store_const", const=_gzip,
                           help='compress archives with ' + _gzip)
         parser.add_option("-j", "--"+_bzip2, dest="compress",
                           action="store_const", const=_bzip2,
                           help='compress archives with ' + _bzip2)
+        parser.add_option("-J", "--"+_xz, dest="compress",
+                          action="store_const", const=_xz,
+                          help='compress archives with ' + _xz)
+        parser.add_option("--"+_zstd, dest="compress",
+                          action="store_const", const=_zstd,
+                          help='compress archives with ' + _zstd + ' (requires '
+                               '`' + _zstd + "' in $PATH)")
+        parser.add_option("--jobs", metavar="N", type="int",
+                          default=os.cpu_count() or 1,
+                          help='expand patterns and compress archives using up '
+                               'to N threads in parallel (default is the '
+                               'number of processors)')
+        parser.add_option("--parallel", metavar="N", type="int", default=1,
+                          help='create up to N archives at the same time '
+                               '(default is 1)')
         opts, args = parser.parse_args(argv[1:])
 
         if opts.help:
@@ -746,12 +2565,20 @@ def parseOptions(argv):
 
         try:
             _target = opts.target
-            os.chdir(_target)
-            os.chdir(_rundir)
+            os.scandir(_target).close()
             _dest = path.abspath(_target)
         except OSError as e:
             raise OptParseError(e.filename + ": " + e.strerror)
 
+        _cache = opts.cache and path.abspath(path.expanduser(opts.cache))
+        _stats_file = opts.stats and path.abspath(path.expanduser(opts.stats))
+
+        if opts.incremental:
+            _incremental = path.abspath(path.expanduser(opts.incremental))
+            _snapshots = loadSnapshots()
+        else:
+            _incremental, _snapshots = None, None
+
         _format = opts.archive
         if not _format:
             raise OptParseError("empty archive name")
@@ -764,18 +2591,85 @@ def parseOptions(argv):
         if opts.extglob:
             _glob = extglob
         else:
-            _glob = glob
-
-        if opts.compress:
-            _compress = [ opts.compress, '--stdout' ]
+            _glob = fileglob
+
+        _jobs = opts.jobs
+        if _jobs < 1:
+            raise OptParseError("invalid number of jobs: %d" % _jobs)
+
+        _parallel = opts.parallel
+        if _parallel < 1:
+            raise OptParseError("invalid number of archives: %d" % _parallel)
+
+        if opts.progress is not None and opts.progress <= 0:
+            raise OptParseError("invalid progress interval: %g" % opts.progress)
+        if (opts.progress or opts.progress_file) and not _simulate:
+            _progress = Progress(opts.progress or 5, bool(opts.progress),
+                                 opts.progress_file and
+                                 path.abspath(path.expanduser(opts.progress_file)))
         else:
-            _compress = None
+            _progress = None
 
-        _cp_default.append('-t')
-        _tar_default.append('-f')
-
-        _tar_create = _tar_default[:1] + [ '--create' ] + _tar_default[1:]
-        _tar_append = _tar_default[:1] + [ '--append' ] + _tar_default[1:]
+        _compress, _compress_cmd = opts.compress, None
+        _block_compressors = {}
+        if _compress:
+            try:
+                _block_compressors[_compress] = blockCompressor(_compress)
+            except ImportError:
+                pass
+            if _compress not in _block_compressors:
+                _compress_cmd = [ _compress, '--stdout' ]
+                if _compress == _zstd:
+                    _compress_cmd += [ '--quiet', '-T%d' % _jobs ]
+
+        if opts.store:
+            if _compress_cmd:
+                raise OptParseError("chunks cannot be compressed with " +
+                                    _compress)
+            _store = ChunkStore(path.abspath(path.expanduser(opts.store)),
+                                _compress, _jobs)
+        else:
+            _store = None
+
+        _seekable = opts.seekable
+        if _seekable and (_compress_cmd or _store):
+            raise OptParseError("--seekable cannot be used with " +
+                                ("--store" if _store else _compress))
+
+        _checksums = opts.checksums
+        if _checksums and _store:
+            raise OptParseError("--checksums cannot be used with --store")
+
+        _dedupe = opts.dedupe
+        if _dedupe and _store:
+            raise OptParseError("--dedupe cannot be used with --store")
+
+        _verify, _live = opts.verify, opts.live
+        if _live and not _verify:
+            raise OptParseError("--live can only be used with --verify")
+
+        _extract, _export, _restore = opts.extract, opts.export, opts.restore
+        if sum(map(bool, (_extract, _export, _restore, _verify))) > 1:
+            raise OptParseError("only one of --extract, --export, --restore "
+                                "and --verify can be used")
+        if _verify:
+            if len(args) == 0:
+                raise OptParseError("no archive specified")
+            return args
+        if _restore:
+            if args:
+                raise OptParseError("input files cannot be used with "
+                                    "--restore")
+            return args
+        if _extract:
+            if len(args) < 2:
+                raise OptParseError("no members or archive specified")
+            return args
+
+        if _export:
+            if args:
+                raise OptParseError("input files cannot be used with --export")
+            return args
 
         if len(args) == 0:
             raise OptParseError("no input file specified")
@@ -800,43 +2694,62 @@ def main(argv=None):
         global __prog__
         __prog__ = path.basename(argv[0])
 
-        updateStatus(0)
         instantiateGlobals()
+        updateStatus(0)
 
         args = parseOptions(argv)
 
-        continued = False
-        for arg in args:
-            try:
-                with open(arg) as file:
-                    if _verbose:
-                        TestPrint(continued)
-                        ProgPrint("reading from", shortPath(arg))
-                        ProgPrint("adding entries to queue")
-                        ProgPrint("D [directory], C [copy], [LH] [dereference]")
-
-                    readFile( file, path.dirname(arg),
-                              path.splitext(path.basename(arg)) [0] )
-                    continued = True
-            except IOError as e:
-                PrintError(e.filename, e.strerror)
-                updateStatus(1)
+        if _export:
+            exportManifest(_export)
+            return _status
+        if _extract:
+            extractMembers(args[-1], args[ : -1])
+            return _status
+        if _restore:
+            with _stats.phase('restore'):
+                Restore(_restore).run()
+            if _stats_file:
+                saveStats(_status)
+            return _status
+        if _verify:
+            with _stats.phase('verify'):
+                for archive in args:
+                    verifyArchive(archive)
+            if _stats_file:
+                saveStats(_status)
+            return _status
+
+        if _progress is not None:
+            _progress.start()
+        continued = readArgs(args)
+
+        if _incremental and not _simulate:
+            saveSnapshots()
+
+        TestPrint(_verbose, "directory cache:", _dircache.hits, "hits,",
+                            _dircache.misses, "misses")
 
         if _status != 0:
             TestPrint(_verbose and continued)
             TestPrint(_verbose, _num_errors, " error",
                       's' if _num_errors > 1 else '', sep='')
+        if _stats_file:
+            saveStats(_status)
         return _status
 
     except Exit as e:
         PrintError(*e.args)
+        if _stats_file:
+            saveStats(e.status)
         return e.status
 
     finally:
         try:
-            for proc in _children:
+            for proc in list(_children):
                 proc.send_signal(signum)
             cleanup()
+            if _progress is not None and _progress.thread.is_alive():
+                _progress.stop()
         except NameError:
             pass
 
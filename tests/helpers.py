@@ -0,0 +1,92 @@
+#########################################################################
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+"""Helpers for the tests: building trees, running the tools and snapshots."""
+
+import sys, os, stat, shutil, subprocess, tempfile, unittest
+from os import path
+
+_top = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, _top)
+
+# keys of spec are relative paths; a str or bytes value is the content of a
+# file, None makes a directory and ('link', target) a symbolic link
+def makeTree(root, spec):
+    for name, value in spec.items():
+        name = path.join(root, name)
+        os.makedirs(path.dirname(name), exist_ok=True)
+        if value is None:
+            os.makedirs(name, exist_ok=True)
+        elif isinstance(value, tuple):
+            os.symlink(value[1], name)
+        else:
+            with open(name, 'wb') as file:
+                file.write(value.encode() if isinstance(value, str) else value)
+
+# what a faithful copy of root must reproduce, by relative path
+def snapshot(root, times=True):
+    entries = {}
+    for dir, dirs, files in os.walk(root):
+        for name in dirs + files:
+            full = path.join(dir, name)
+            st = os.lstat(full)
+            if stat.S_ISLNK(st.st_mode):
+                value = ('link', os.readlink(full))
+            elif stat.S_ISDIR(st.st_mode):
+                value = ('dir', stat.S_IMODE(st.st_mode))
+            else:
+                with open(full, 'rb') as file:
+                    value = ('file', stat.S_IMODE(st.st_mode), file.read())
+                if times:
+                    value += (int(st.st_mtime),)
+            entries[path.relpath(full, root)] = value
+    return entries
+
+def names(root):
+    return sorted(snapshot(root, times=False))
+
+def runTool(tool, *args, input=None, cwd=None):
+    return subprocess.run([ sys.executable, path.join(_top, tool) ]
+                          + list(args), input=input, cwd=cwd,
+                          capture_output=True, text=True)
+
+need_rsync = unittest.skipIf(shutil.which('rsync') is None,
+                             "rsync is not installed")
+need_tar = unittest.skipIf(shutil.which('tar') is None,
+                           "tar is not installed")
+
+class TreeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='tarf-test-')
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+    def path(self, *names):
+        return path.join(self.root, *names)
+
+    def writeDefs(self, name, lines):
+        name = self.path(name)
+        with open(name, 'w') as file:
+            file.write(''.join(line + '\n' for line in lines))
+        return name
+
+    def assertRun(self, tool, *args, status=0, **kwargs):
+        proc = runTool(tool, *args, **kwargs)
+        self.assertEqual(proc.returncode, status,
+                         "%s %s:\n%s%s" % (tool, ' '.join(args),
+                                           proc.stdout, proc.stderr))
+        return proc
@@ -0,0 +1,98 @@
+#########################################################################
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+import os, unittest
+from os import path
+from unittest import mock
+
+from helpers import TreeTestCase, makeTree, snapshot
+import backuputils
+from backuputils import removeTree
+
+class RemoveTest(TreeTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.errors = []
+
+    def onerror(self, name, msg):
+        self.errors.append((name, msg))
+
+    def makeWide(self, top):
+        spec = { 'outside/keep': 'keep' }
+        for i in range(8):
+            for j in range(20):
+                spec['%s/d%d/e%d/f' % (top, i, j)] = 'x' * j
+            spec['%s/d%d/link' % (top, i)] = ('link', '../../outside')
+        makeTree(self.root, spec)
+        return (sum(1 for name in snapshot(self.path(top))) + 1,
+                sum(j for i in range(8) for j in range(20)))
+
+    def testWide(self):
+        for jobs in (1, 4):
+            top = 'top%d' % jobs
+            count, size = self.makeWide(top)
+            self.assertEqual(removeTree(self.path(top), self.onerror, jobs),
+                             (count, size, 0))
+            self.assertFalse(path.lexists(self.path(top)))
+            # symbolic links are removed, not followed
+            self.assertEqual(os.listdir(self.path('outside')), [ 'keep' ])
+        self.assertEqual(self.errors, [])
+
+    def testDeep(self):
+        # deeper than the recursion limit, with parents reopened through '..'
+        depth = 2000
+        fd = os.open(self.root, os.O_RDONLY | os.O_DIRECTORY)
+        for i in range(depth):
+            os.mkdir('d', dir_fd=fd)
+            sub = os.open('d', os.O_RDONLY | os.O_DIRECTORY, dir_fd=fd)
+            os.close(fd)
+            fd = sub
+        os.close(os.open('f', os.O_WRONLY | os.O_CREAT, dir_fd=fd))
+        os.close(fd)
+        with mock.patch.object(backuputils, '_open_dirs', 8):
+            self.assertEqual(removeTree(self.path('d'), self.onerror),
+                             (depth + 1, 0, 0))
+        self.assertEqual(os.listdir(self.root), [])
+        self.assertEqual(self.errors, [])
+
+    def testFile(self):
+        makeTree(self.root, { 'file': 'data', 'link': ('link', 'file') })
+        self.assertEqual(removeTree(self.path('link'), self.onerror),
+                         (1, 0, 0))
+        self.assertEqual(removeTree(self.path('file'), self.onerror),
+                         (1, 4, 0))
+        self.assertEqual(removeTree(self.path('file'), self.onerror),
+                         (0, 0, 0))
+        self.assertEqual(os.listdir(self.root), [])
+
+    def testErrors(self):
+        self.assertEqual(removeTree(os.sep, self.onerror), (0, 0, 1))
+        makeTree(self.root, { 'file': 'data' })
+        self.assertEqual(removeTree(self.path('file', 'sub'), self.onerror),
+                         (0, 0, 1))
+        self.assertEqual([ name for name, msg in self.errors ],
+                         [ os.sep, self.path('file') ])
+
+    def testMissingParent(self):
+        # the parent may have been removed before, as a whole
+        self.assertEqual(removeTree(self.path('missing', 'file'),
+                                    self.onerror), (0, 0, 0))
+        self.assertEqual(self.errors, [])
+
+if __name__ == '__main__':
+    unittest.main()
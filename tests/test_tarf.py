@@ -0,0 +1,148 @@
+#########################################################################
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+import os, stat, subprocess, unittest
+from os import path
+
+from helpers import TreeTestCase, makeTree, snapshot, names, need_tar
+
+_mtime = 1234567890
+
+def linkGroups(root):
+    inodes = {}
+    for dir, dirs, files in os.walk(root):
+        for name in files:
+            st = os.lstat(path.join(dir, name))
+            if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                inodes.setdefault(st.st_ino, []).append(
+                    path.relpath(path.join(dir, name), root))
+    return sorted(sorted(group) for group in inodes.values())
+
+def dirTimes(root):
+    return { path.relpath(dir, root): int(os.stat(dir).st_mtime)
+             for dir, dirs, files in os.walk(root) if dir != root }
+
+class RestoreTest(TreeTestCase):
+
+    def setUp(self):
+        super().setUp()
+        tree = self.path('src', 'tree')
+        makeTree(tree, {
+            'a': 'a', 'big': os.urandom(3 << 20), 'mode': 'm',
+            'sub/hard': None, 'sub/sym': ('link', '../a'), 'sub/empty': None,
+            'sub/deep/x/y/z': 'z', 'gone/f': 'f',
+        })
+        os.rmdir(path.join(tree, 'sub', 'hard'))
+        os.link(path.join(tree, 'a'), path.join(tree, 'sub', 'hard'))
+        os.chmod(path.join(tree, 'mode'), 0o604)
+        os.chmod(path.join(tree, 'sub', 'deep'), 0o750)
+        self.touch(tree)
+        os.mkdir(self.path('out'))
+        self.defs = self.writeDefs('tree.def',
+                                   [ self.path('src', '.', 'tree') ])
+
+    def touch(self, root):
+        for dir, dirs, files in os.walk(root, topdown=False):
+            for name in dirs + files:
+                os.utime(path.join(dir, name), (_mtime, _mtime),
+                         follow_symlinks=False)
+        os.utime(root, (_mtime, _mtime))
+
+    def archive(self, *args):
+        self.assertRun('tarf.py', '-t', self.path('out'), '-g',
+                       self.path('snap'), *args, self.defs)
+
+    def restore(self, archive, dest, *args):
+        os.makedirs(dest, exist_ok=True)
+        self.assertRun('tarf.py', '-t', dest, '--restore=' + archive, *args)
+
+    def extract(self, archive, dest):
+        os.makedirs(dest, exist_ok=True)
+        subprocess.run([ 'tar', '-xpf', archive, '-C', dest ], check=True)
+
+    def assertSameTree(self, first, second):
+        self.assertEqual(snapshot(first), snapshot(second))
+        self.assertEqual(linkGroups(first), linkGroups(second))
+        self.assertEqual(dirTimes(first), dirTimes(second))
+
+    def testRestore(self):
+        self.archive()
+        archive = self.path('out', 'tree.tar')
+        for jobs in (1, 4):
+            dest = self.path('restored%d' % jobs)
+            self.restore(archive, dest, '--jobs=%d' % jobs)
+            self.assertSameTree(self.path('src'), dest)
+            self.assertEqual(linkGroups(dest), [ [ 'tree/a', 'tree/sub/hard' ] ])
+
+    @need_tar
+    def testSameAsTar(self):
+        self.archive('-z')
+        archive = self.path('out', 'tree.tar.gz')
+        self.restore(archive, self.path('restored'), '--jobs=4')
+        self.extract(archive, self.path('extracted'))
+        self.assertSameTree(self.path('restored'), self.path('extracted'))
+
+    def changeTree(self):
+        tree = self.path('src', 'tree')
+        os.remove(path.join(tree, 'sub', 'deep', 'x', 'y', 'z'))
+        os.remove(path.join(tree, 'gone', 'f'))
+        os.rmdir(path.join(tree, 'gone'))
+        makeTree(tree, { 'new/n': 'n', 'a': 'changed' })
+        self.touch(tree)
+
+    def testIncremental(self):
+        self.archive()
+        self.changeTree()
+        self.archive('-a', 'incr')
+        dest = self.path('restored')
+        for name in ('tree.tar', 'incr.tar'):
+            self.restore(self.path('out', name), dest)
+        # files gone from the source are removed again
+        self.assertSameTree(self.path('src'), dest)
+        self.assertNotIn('tree/gone', names(dest))
+
+    @need_tar
+    def testIncrementalSameAsTar(self):
+        self.archive()
+        self.changeTree()
+        self.archive('-a', 'incr')
+        restored, extracted = self.path('restored'), self.path('extracted')
+        for name in ('tree.tar', 'incr.tar'):
+            self.restore(self.path('out', name), restored)
+            self.extract(self.path('out', name), extracted)
+
+        # tar knows nothing of the deleted list; apply it by hand
+        with open(path.join(extracted, '.tarf-deleted'), 'rb') as file:
+            deleted = sorted(os.fsdecode(name)
+                             for name in file.read().split(b'\0') if name)
+        os.remove(path.join(extracted, '.tarf-deleted'))
+        self.assertEqual(deleted, [ 'tree/gone', 'tree/gone/f',
+                                    'tree/sub/deep/x/y/z' ])
+        for name in reversed(deleted):
+            name = path.join(extracted, name)
+            if path.isdir(name):
+                os.rmdir(name)
+            else:
+                os.remove(name)
+        for name in deleted:
+            parent = path.join(extracted, path.dirname(name))
+            if path.isdir(parent):
+                os.utime(parent, (_mtime, _mtime))
+        self.assertSameTree(restored, extracted)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#########################################################################
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+import os, shutil, subprocess, unittest
+from unittest import mock
+from os import path
+
+from helpers import TreeTestCase, makeTree, snapshot, names, need_rsync
+import yarf
+
+class NativeDeleteTest(TreeTestCase):
+
+    def setUp(self):
+        super().setUp()
+        makeTree(self.path('n1'), { 'a': 'a', 'sub/s': 's' })
+        makeTree(self.path('n2'), { 'b': 'b', 'sub/t': 't' })
+        makeTree(self.path('f'), { 'top': 'top' })
+        self.defs = self.writeDefs('sync.def', [ self.path('n1') + os.sep,
+                                                 self.path('n2') + os.sep,
+                                                 self.path('f', 'top') ])
+
+    def stale(self, dest):
+        makeTree(dest, { 'stale': 'x', 'old/deep/file': 'x', 'sub/gone': 'x' })
+
+    def sync(self, dest, *args):
+        return self.assertRun('yarf.py', '-d', '-t', dest, *args, self.defs)
+
+    def testEntriesIntoOneDirectory(self):
+        dest = self.path('dest')
+        self.stale(dest)
+        for i in range(2):
+            self.sync(dest, '--engine=native', '--jobs=4')
+            # every entry's files survive the others' --delete
+            self.assertEqual(names(dest), [ 'a', 'b', 'sub', 'sub/s', 'sub/t',
+                                            'top' ])
+
+    def testNoTemporaryFilesLeft(self):
+        dest = self.path('dest')
+        for size in (65536, 131072):
+            for i in range(50):
+                makeTree(self.path('n2'), { 'big%02d' % i: os.urandom(size) })
+            self.stale(dest)
+            self.sync(dest, '--engine=native', '--jobs=8')
+            self.assertEqual(len(os.listdir(dest)), 54)
+            self.assertEqual(path.getsize(path.join(dest, 'big00')), size)
+
+    def testSimulate(self):
+        dest = self.path('dest')
+        self.sync(dest, '--engine=native')
+        self.stale(dest)
+        before = snapshot(dest)
+        proc = self.sync(dest, '--engine=native', '-n')
+        self.assertEqual(snapshot(dest), before)
+        deleted = sorted(line for line in proc.stdout.splitlines()
+                         if line.startswith('deleting '))
+        self.assertEqual(deleted, [ 'deleting old', 'deleting stale',
+                                    'deleting sub/gone' ])
+
+    @need_rsync
+    def testSameAsRsync(self):
+        native, rsync = self.path('native'), self.path('rsync')
+        for dest in (native, rsync):
+            self.stale(dest)
+        for i in range(2):
+            self.sync(native, '--engine=native')
+            self.sync(rsync)
+            self.assertEqual(snapshot(native), snapshot(rsync))
+
+class PurgeTest(TreeTestCase):
+
+    def setUp(self):
+        super().setUp()
+        makeTree(self.path('src'), {
+            'p1/a.conf': 'new', 'p1/keep.txt': 'k', 'p1/d.conf/f': 'f',
+            'p2/b.conf': 'b',
+        })
+        makeTree(self.path('dest'), {
+            'p1/a.conf': 'old', 'p1/stale.conf': 'x', 'p1/x.conf/in/f': 'x',
+            'p1/c.txt': 'c', 'p2/b.conf': 'b', 'p2/gone.conf': 'x',
+            'p2/x.conf': None, 'top.conf': 'x',
+        })
+        self.defs = self.writeDefs('purge.def', [
+            '! ' + self.path('src', '.', '*', '*.conf') ])
+
+    def purge(self, dest, *args):
+        return self.assertRun('yarf.py', '--engine=native', '-t', dest, *args,
+                              self.defs)
+
+    def testPurge(self):
+        os.symlink('missing', self.path('src', 'p2', 'dead.conf'))
+        makeTree(self.path('dest'), { 'p2/dead.conf': 'x',
+                                      'only/z.conf': 'x', 'only/z.txt': 'x' })
+        self.purge(self.path('dest'), '--jobs=4')
+        self.assertEqual(names(self.path('dest')), [
+            'only', 'only/z.txt',
+            'p1', 'p1/a.conf', 'p1/c.txt', 'p1/d.conf', 'p1/d.conf/f',
+            'p2', 'p2/b.conf', 'p2/dead.conf', 'top.conf',
+        ])
+        self.assertTrue(path.islink(self.path('dest', 'p2', 'dead.conf')))
+
+    def testSimulate(self):
+        before = snapshot(self.path('dest'))
+        self.purge(self.path('dest'), '-n')
+        self.assertEqual(snapshot(self.path('dest')), before)
+
+    @need_rsync
+    def testSameAsRsync(self):
+        dest, copy = self.path('dest'), self.path('copy')
+        shutil.copytree(dest, copy, symlinks=True)
+        self.purge(dest)
+        # delete what matches and is gone from the source, transfer nothing,
+        # then transfer the matches
+        subprocess.run([ 'rsync', '-r', '--delete', '--existing',
+                         '--ignore-existing', '--include=/*/',
+                         '--include=/*/*.conf', '--include=/*/*.conf/**',
+                         '--exclude=*', self.path('src') + os.sep,
+                         copy + os.sep ], check=True)
+        subprocess.run([ 'rsync', '-aR' ] +
+                       [ self.path('src', '.', dir, name)
+                         for dir in ('p1', 'p2')
+                         for name in os.listdir(self.path('src', dir))
+                         if name.endswith('.conf') ] +
+                       [ copy ], check=True)
+        self.assertEqual(snapshot(dest), snapshot(copy))
+
+class ShardTest(unittest.TestCase):
+
+    def setUp(self):
+        for name, value in (('_relative_pat', os.sep + '.' + os.sep),
+                            ('_delete', False), ('_shards', 4)):
+            patcher = mock.patch.object(yarf, name, value, create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def testSameDestinationShared(self):
+        shards = yarf.shardList([ '/a/x', '/b/y', '/c/x', '/d/x/' ], False, 4)
+        self.assertIn([ '/a/x', '/c/x' ], shards)
+        shards = yarf.shardList([ '/r/./a/b', '/r/./c', '/s/./a/' ], True, 4)
+        self.assertIn([ '/r/./a/b', '/s/./a/' ], shards)
+
+    def testDeleteIntoDestination(self):
+        for entries, relative in (([ '/n1/', '/n2/', '/a/x' ], False),
+                                  ([ '/r/./a/b', '/s/./' ], True)):
+            yarf._delete = False
+            self.assertGreater(len(yarf.shardList(entries, relative, 4)), 1)
+            yarf._delete = True
+            self.assertEqual(yarf.shardList(entries, relative, 4), [ entries ])
+        self.assertEqual(yarf.shardIndex('/a/x', False), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -23,14 +23,20 @@
 #
 #########################################################################
 
-import sys, os, signal, re
+import sys, os, signal, re, stat, threading, errno
 from os import path
-from glob import glob
 from subprocess import Popen, PIPE
+from time import time_ns, perf_counter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from backuputils import DirCache, Plan, Stats, extglob, fileglob, \
+                        planPath, removeAt, removeTree
 
 __version__ = "0.5"
 __usage__ = ("Usage: %prog [-t DEST] [-s SRC] [-o RSYNC_OPTS]... "
-                          "[-dzn] [-LHrve] [FILE]...")
+                          "[-dzn] [-LHrve] [--jobs=N] [--shards=N] "
+                          "[--pipeline] [--watch] [--debounce=SECONDS] "
+                          "[--stats=FILE] [FILE]...")
 __doc__ = """
 Read file patterns from files or standard input and invoke `rsync' to transfer
 files to a destination given by the "-t" option. Each line is read as a
@@ -72,30 +78,63 @@ be purged. This operation is only attempted if DEST is local.
 Implied directories are also used for changing the source directory
 with the "-s" option. If SRC is set to /mnt, then /mnt/.config/*.conf and
 /mnt/*/bar would be transferred instead.
+
+Entries that need different rsync options are transferred by separate rsync
+processes, which run at the same time (see the "--jobs" option). With the
+"--shards" option, the entries of each kind are further split into groups by
+the top-level destination entry they write into, so that several rsync
+processes can build their file lists in parallel. With "--delete", entries
+that write straight into DEST (such as a source directory with a trailing
+slash) keep all the entries of their kind in one rsync process, and
+"--pipeline" does not shard at all, so that no process deletes what another
+one transferred.
+
+With the "--pipeline" option, rsync is started as soon as the first local entry
+of each kind is found, and is fed further entries while the input files are
+still being read. At most "--jobs" rsync processes run at once; when another
+one is needed, the one used least recently is left to finish first. With
+"--delete", each kind keeps its one rsync process until the end instead, as a
+later process would delete what the earlier one transferred.
+
+With "--engine=native", files are transferred by %(__prog__)s itself instead of
+rsync, which requires the sources and the destination to be local. Files are
+compared by size and modification time, and changed files are copied on
+several threads into a temporary file that is then renamed over the old one.
+
+With the "--watch" option, %(__prog__)s keeps running after the first transfer
+and watches the matched files and directories with inotify. Changed paths are
+collected until nothing has changed for the "--debounce" interval, and only
+those paths are transferred again. New files that match the patterns are
+transferred as well. Deleted files are only removed from the destination with
+"-d".
 """
 
 __debugging__ = False
 
-def Debug(*args, sep=' ', file=sys.stderr):
+def Debug(*args, sep=' ', file=None):
     if __debugging__:
-        ProgPrint(*args, name="db", sep=sep, file=file)
+        ProgPrint(*args, name="db", sep=sep, file=file or sys.stderr)
 
-def ProgPrint(*args, name=None, sep=' ', end='\n', file=sys.stdout):
+def ProgPrint(*args, name=None, sep=' ', end='\n', file=None):
     if name is None:
         name = __prog__
+    if file is None:
+        file = sys.stdout
     if len(args) == 0:
         print(file=file, end=end)
     else:
         print(name+': '+sep.join(map(str, args)), end=end, file=file)
 
-def TestPrint(condition, *args, prog=True, sep=' ', end='\n', file=sys.stdout):
+def TestPrint(condition, *args, prog=True, sep=' ', end='\n', file=None):
     if condition:
         if prog:
             ProgPrint(*args, sep=sep, end=end, file=file)
         else:
             print(*args, sep=sep, end=end, file=file)
 
-def PrintError(*args, sep=': ', end='\n', file=sys.stderr):
+def PrintError(*args, sep=': ', end='\n', file=None):
+    if file is None:
+        file = sys.stderr
     pargs = []
     for arg in args:
         if arg is not None and arg != '':
@@ -145,16 +184,9 @@ def normPath(path):
 def shortPath(path):
     return _re_home.sub('~', path)
 
-def walkRemove(top):
-    if path.isfile(top) or path.islink(top):
-        os.remove(top)
-    elif path.isdir(top):
-        for root, dirs, files in os.walk(top, topdown=False):
-            for name in files:
-                os.remove(path.join(root, name))
-            for name in dirs:
-                os.rmdir(path.join(root, name))
-        os.rmdir(top)
+def removeFailed(name, msg):
+    PrintError("error removing destination file", shortPath(name), msg)
+    updateStatus(1)
 
 
 def parseLine(line):
@@ -174,14 +206,15 @@ def parseLine(line):
         if _re_bare_quote.search(line):
             PrintError("syntax", "unterminated quote", line)
             updateStatus(1)
-            return ''
+            return leading_flags, ''
     if '\\' in line:
         line = _re_escaped.sub(r'\g<repl>', line)
     if os.sep * 2 in line:
         line = normPath(line)
     return leading_flags, _re_repeated_relative.sub(r'\g<repl>', line)
 
-def processLine(line):
+def compileLine(plan, line, filedir):
+    plan.addEnv(_re_leading_flags.match(line).group('line'))
     flags, pattern = parseLine(line)
 
     if not pattern:
@@ -191,17 +224,19 @@ def processLine(line):
         return False
 
     link = _link_chr in flags
-    purge = _purge and _purge_chr in flags
+    purge = _purge_chr in flags
 
     if link:
+        link_path = path.join(filedir, pattern)
+        links = _glob(_dircache, link_path)
+        plan.globs.append([ link_path, links[:] ])
+        if not links:
+            links.append(link_path)
         try:
-            link_path = path.join(_filedir, pattern)
-            links = _glob(link_path)
-            if not links:
-                links.append(link_path)
             for link in links:
                 with open(link) as file:
-                    readFile(file, path.dirname(link))
+                    plan.addFile(link)
+                    compileLines(plan, file, path.dirname(link))
             return True
         except IOError as e:
             PrintError(e.filename, e.strerror)
@@ -236,6 +271,13 @@ def processLine(line):
 
     implied_pat = max(implied_pat, glob_pat, key=len)
 
+    plan.ops.append([ 'purge' if purge else 'sync', pattern, relative,
+                      implied_pat ])
+    return True
+
+def processPattern(purge, pattern, relative, implied_pat):
+    purge = _purge and purge
+
     if _source:
         if implied_pat:
             pattern = path.join(_source, implied_pat)
@@ -244,7 +286,7 @@ def processLine(line):
             updateStatus(1)
             return False
 
-    fileList = _glob(pattern)
+    fileList = _glob(_dircache, pattern)
 
     if not fileList:
         if not _remote:
@@ -252,6 +294,7 @@ def processLine(line):
             updateStatus(1)
             return False
         fileList.append(pattern)
+        _remote_entries.add(pattern)
         local = False
     else:
         local = True
@@ -270,10 +313,10 @@ def processLine(line):
             relative_entry = relative
             follow = False
 
-            if path.islink(entry):
-                if path.isfile(entry):
+            if _dircache.islink(entry):
+                if _dircache.isfile(entry):
                     follow = True
-                elif path.isdir(entry):
+                elif _dircache.isdir(entry):
                     if not relative:
                         pos = len(path.dirname(entry))
                         if pos == 0:
@@ -290,8 +333,12 @@ def processLine(line):
 
 
 def purgeMatching(pat, dest, src):
+    with _stats.phase('purge'):
+        purgeDestination(pat, dest, src)
+
+def purgeDestination(pat, dest, src):
     dest_pat = path.join(dest, pat)
-    destList = _glob(dest_pat)
+    destList = _glob(_dircache, dest_pat)
     if not destList:
         return
     TestPrint(_verbose)
@@ -299,39 +346,128 @@ def purgeMatching(pat, dest, src):
                         "to be purged:", shortPath(dest_pat))
     multi = len(destList) > 1
     if not _simulate:
-        for entry in destList:
-            if path.exists(path.join(src, entry[len(dest) : ].lstrip(os.sep))):
-                continue
-            try:
-                walkRemove(entry)
-                TestPrint(_verbose and multi, shortPath(entry), prog=False)
-            except OSError as e:
-                PrintError("error removing destination file",
-                           e.filename, e.strerror)
-                updateStatus(1)
+        groups = staleEntries(destList, dest, src)
+        _dircache.invalidate(*[ path.join(parent, name)
+                                for parent, names in groups.items()
+                                for name in names ])
+        count, size = 0, 0
+        jobs = _jobs if len(groups) == 1 else 1
+        with ThreadPoolExecutor(min(_jobs, len(groups)) or 1) as executor:
+            for removed in executor.map(lambda group: purgeGroup(*group, jobs),
+                                        groups.items()):
+                for entry, entry_count, entry_size in removed:
+                    TestPrint(_verbose and multi, shortPath(entry), prog=False)
+                    count += entry_count
+                    size += entry_size
+        TestPrint(_verbose, "purged", count, "entries,", size, "bytes")
+        _stats.add('purges', { 'pattern': dest_pat, 'entries': count,
+                               'bytes': size })
     TestPrint(_verbose)
 
-def queueAdd(entry, relative, follow=False):
+def staleEntries(destList, dest, src):
+    names = {}
+    for entry in destList:
+        parent, name = path.split(entry.rstrip(os.sep))
+        names.setdefault(parent, set()).add(name)
+
+    groups = {}
+    for parent, dest_names in names.items():
+        src_dir = path.join(src, parent[len(dest) : ].lstrip(os.sep))
+        listing = _dircache.scandir(src_dir) or {}
+        stale = dest_names - listing.keys()
+        for name in dest_names & listing.keys():
+            if listing[name].is_symlink() and \
+               not _dircache.stat(path.join(src_dir, name)):
+                stale.add(name)
+        if stale:
+            groups[parent] = sorted(stale)
+    return groups
+
+def purgeGroup(parent, names, jobs=1):
+    removed = []
+    try:
+        dir_fd = os.open(parent or os.curdir, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError as e:
+        removeFailed(parent, e.strerror)
+        return removed
+
+    try:
+        for name in names:
+            entry = path.join(parent, name)
+            count, size, errors = removeAt(dir_fd, name, entry,
+                                           removeFailed, jobs)
+            if count:
+                removed.append((entry, count, size))
+    finally:
+        os.close(dir_fd)
+    return removed
+
+def queueAdd(entry, relative, follow=False, watch=True):
+    if watch and _watch is not None and \
+       not _watch.addEntry(entry, relative, follow):
+        return
     s = '_'
     TestPrint(_verbose, "[%c%c] " % ('R' if relative else s,
                                      'L' if follow else s),
                         shortPath(entry), prog=False)
-    _queues[(relative, follow)].append(entry)
+    if _pipes is not None and entry not in _remote_entries:
+        pipeFor(relative, follow, entry).add(entry)
+    else:
+        _queues[(relative, follow)].append(entry)
 
 
-def readFile(file, filedir):
-    global _filedir
+def saveStats(status):
+    try:
+        _stats.save(_stats_file, program=__prog__, version=__version__,
+                    status=status, errors=_num_errors, engine=_engine)
+    except OSError as e:
+        PrintError("error saving statistics", e.filename, e.strerror)
+
+def readPlan(file, filedir):
+    cache = None
+    if _cache and file is not sys.stdin:
+        cache = planPath(_cache, __prog__, file.name, _rundir)
+        plan = Plan.load(cache, __version__)
+        if plan is not None and plan.isCurrent(_dircache, _glob):
+            TestPrint(_verbose, "using compiled plan", shortPath(cache))
+            return plan
+
+    plan = Plan(__version__)
+    if cache:
+        plan.addFile(file.name)
+
+    num_errors = _num_errors
+    compileLines(plan, file, filedir)
+    if cache and _num_errors == num_errors:
+        try:
+            plan.save(cache)
+        except OSError as e:
+            PrintError("error saving compiled plan", e.filename, e.strerror)
 
-    saved_filedir = _filedir
-    _filedir = filedir
+    return plan
 
+def compileLines(plan, file, filedir):
     for line in file:
-        processLine(line.strip())
+        compileLine(plan, line.strip(), filedir)
+
+def runPlan(plan):
+    for op in plan.ops:
+        processPattern(op[0] == 'purge', *op[1:])
+        if _pipes:
+            for pipe in _pipes.values():
+                pipe.flush()
 
-    _filedir = saved_filedir
+def readFile(file, filedir):
+    with _stats.phase('parse'):
+        plan = readPlan(file, filedir)
+    with _stats.phase('expand'):
+        runPlan(plan)
+    if _watch is not None:
+        _watch.addPlan(plan)
 
 def runProc(argv, stdout=None, stderr=None, input=None, text=True,
             ignore_code=False):
+    started = perf_counter()
     try:
         proc = Popen(argv, stdout=stdout, stderr=stderr,
                      stdin=(None if input is None else PIPE),
@@ -346,55 +482,813 @@ def runProc(argv, stdout=None, stderr=None, input=None, text=True,
         out, err = proc.communicate(input)
     except OSError:
         out, err = None, None
-    _children.remove(proc)
+    _children.discard(proc)
 
     code = proc.poll()
+    _stats.addChild(argv, perf_counter() - started, code)
     if code != 0 and not ignore_code:
         updateStatus(code)
 
     return out, err, code
 
-def rsyncList(srcList, relative, follow):
-    if not srcList:
-        return
+def startProc(argv, stdin=None, stdout=None, stderr=None):
+    started = perf_counter()
+    try:
+        proc = Popen(argv, stdin=stdin, stdout=stdout, stderr=stderr)
+    except OSError:
+        raise Fatal(127, argv[0], "command not found")
+
+    proc.started = started
+    _children.add(proc)
+    return proc
+
+def waitProc(proc, ignore_code=False):
+    if proc.stdin:
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+    code = proc.wait()
+    _children.discard(proc)
+    _stats.addChild(proc.args, perf_counter() - proc.started, code)
+
+    if code != 0 and not ignore_code:
+        updateStatus(code)
+
+    return code
 
+def filesFromArgv(relative, follow):
     options = []
-    if relative:
-        options.append('--relative')
     if follow:
         options.append('--copy-links')
+    return _rsync_default + options + [
+               '--recursive', '--from0', '--files-from=-',
+               '--relative' if relative else '--no-relative', os.sep, _dest ]
+
+def filesFromEntry(entry):
+    return os.fsencode(path.join(_rundir, entry)) + b'\0'
+
+class RsyncPipe:
+
+    def __init__(self, relative, follow):
+        self.proc = startProc(filesFromArgv(relative, follow), stdin=PIPE)
+        self.broken = False
+        self.entries = 0
+
+    def add(self, entry):
+        self.entries += 1
+        if self.broken:
+            return
+        try:
+            self.proc.stdin.write(filesFromEntry(entry))
+        except BrokenPipeError:
+            self.broken = True
+
+    def flush(self):
+        if self.broken:
+            return
+        try:
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            self.broken = True
+
+    def close(self):
+        return waitProc(self.proc)
+
+def pipeFor(relative, follow, entry):
+    key = (relative, follow, shardIndex(entry, relative))
+    try:
+        # keep the most recently used pipes last
+        pipe = _pipes.pop(key)
+    except KeyError:
+        # a second process for the same kind would --delete the first's files
+        if len(_pipes) >= _jobs and not _delete:
+            closePipe(next(iter(_pipes)))
+        printSync()
+        pipe = RsyncPipe(relative, follow)
+    _pipes[key] = pipe
+    return pipe
+
+def closePipe(key):
+    pipe = _pipes.pop(key)
+    pipe.close()
+    _piped[key[ : 2]] = _piped.get(key[ : 2], 0) + pipe.entries
+
+def closePipes():
+    while _pipes:
+        closePipe(next(iter(_pipes)))
+
+def printSync():
+    global _sync_printed
+    if not _verbose or _sync_printed:
+        return
+    _sync_printed = True
+    ProgPrint("destination is set to", shortPath(_dest))
+    if _engine == 'native':
+        TestPrint(not _simulate, "syncing with the native engine",
+                  "(%d jobs)" % _jobs)
+    else:
+        ProgPrint('invoking rsync with "' if not _simulate else
+                  'rsync would be invoked with "',
+                  ' '.join(_rsync_default[1:]), '"', sep='')
+
+def rsyncList(srcList, relative, follow):
+    if not srcList:
+        return
+
+    localList, remoteList = [], []
+    for entry in srcList:
+        if entry in _remote_entries:
+            remoteList.append(entry)
+        else:
+            localList.append(entry)
+
+    if localList:
+        runProc(filesFromArgv(relative, follow), text=False,
+                input=b''.join(map(filesFromEntry, localList)))
+
+    if remoteList:
+        options = []
+        if relative:
+            options.append('--relative')
+        if follow:
+            options.append('--copy-links')
+        runProc(_rsync_default + options + remoteList + [ _dest ])
+
+def shardKey(entry, relative):
+    # the top-level destination entry written to, or '' for the destination
+    # itself, so that everything a --delete may prune shares one shard
+    if not relative:
+        if entry.endswith(os.sep):
+            return ''
+        return path.basename(entry.rstrip(os.sep))
+    pos = entry.find(_relative_pat)
+    if pos >= 0:
+        entry = entry[pos + len(_relative_pat) : ]
+    return entry.lstrip(os.sep).split(os.sep, 1)[0]
+
+def shardIndex(entry, relative):
+    # entries still to come may write into the destination itself
+    if _shards < 2 or _delete:
+        return 0
+    import zlib
+    return zlib.crc32(os.fsencode(shardKey(entry, relative))) % _shards
+
+def shardList(srcList, relative, count):
+    if count < 2 or len(srcList) < 2:
+        return [ srcList ]
+
+    groups = {}
+    for entry in srcList:
+        groups.setdefault(shardKey(entry, relative), []).append(entry)
+    if _delete and '' in groups:
+        return [ srcList ]
+
+    shards = [ [] for i in range(min(count, len(groups))) ]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(shards, key=len).extend(group)
+    return shards
+
+def nativeList(srcList, relative, follow):
+    sync = NativeSync(follow)
+    try:
+        for entry in srcList:
+            if entry in _remote_entries:
+                PrintError(entry, "remote sources need the rsync engine")
+                updateStatus(1)
+            else:
+                sync.addEntry(entry, relative)
+        sync.prune()
+    finally:
+        sync.finish()
+        _stats.add('transfers', {
+            'relative': relative,
+            'follow':   follow,
+            'entries':  len(srcList),
+            'files':    sync.files,
+            'bytes':    sync.bytes,
+            'deleted':  sync.deleted,
+        })
+
+class NativeSync:
+
+    def __init__(self, follow):
+        self.follow = follow
+        self.dirs = []
+        self.created = set()
+        self.pending = deque()
+        self.max_pending = 4 * _jobs
+        self.executor = ThreadPoolExecutor(_jobs)
+        self.root = path.abspath(_dest)
+        self.files, self.bytes, self.deleted = 0, 0, 0
+        self.keep = {}      # destination directory: names synced into it
+        self.existing = {}  # existing destination directory: its name
+        self.errors = False
+
+    def addEntry(self, entry, relative):
+        src = path.join(_rundir, entry)
+        follow = self.follow or entry.endswith(os.sep)
+
+        if relative:
+            pos = entry.find(_relative_pat)
+            if pos >= 0:
+                base = path.join(_rundir, entry[ : pos])
+                name = entry[pos + len(_relative_pat) : ]
+            else:
+                base = os.sep if path.isabs(entry) else _rundir
+                name = entry
+            name = path.normpath(name.strip(os.sep))
+            parent = ''
+            for part in path.dirname(name).split(os.sep):
+                if part:
+                    parent = path.join(parent, part)
+                    self.addImplied(path.join(base, parent), parent)
+        elif entry.endswith(os.sep):
+            name = ''
+        else:
+            name = path.basename(entry)
+
+        self.syncEntry(src, name, follow)
+
+    def addImplied(self, src, name):
+        dst = path.join(self.root, name)
+        if path.isdir(dst) or name in self.created:
+            return
+        try:
+            st = os.stat(src)
+            self.printName(name + os.sep)
+            if not _simulate:
+                os.mkdir(dst, 0o700)
+                self.dirs.append((dst, st))
+            self.created.add(name)
+        except OSError as e:
+            self.failed(e)
+
+    def syncEntry(self, src, name, follow, parents=()):
+        dst = path.join(self.root, name) if name else self.root
+        try:
+            st = os.stat(src) if follow else os.lstat(src)
+        except FileNotFoundError as e:
+            if follow and path.islink(src):
+                PrintError(shortPath(src), "symlink has no referent")
+                updateStatus(23)
+                self.errors = True
+            else:
+                self.failed(e)
+            return
+        except OSError as e:
+            self.failed(e)
+            return
+        if _delete and name:
+            dir, base = path.split(dst)
+            self.keep.setdefault(dir, set()).add(base)
+
+        try:
+            dst_st = os.lstat(dst)
+        except FileNotFoundError:
+            dst_st = None
+        except OSError as e:
+            self.failed(e)
+            return
+
+        try:
+            if stat.S_ISDIR(st.st_mode):
+                inode = (st.st_dev, st.st_ino)
+                if inode in parents:
+                    PrintError(shortPath(src), "file system loop detected")
+                    updateStatus(23)
+                    return
+                self.syncDir(src, dst, name, st, dst_st, follow,
+                             parents + (inode,))
+            elif stat.S_ISREG(st.st_mode):
+                self.syncFile(src, dst, name, st, dst_st)
+            elif stat.S_ISLNK(st.st_mode):
+                self.syncLink(src, dst, name, st, dst_st)
+            else:
+                self.syncSpecial(dst, name, st, dst_st)
+        except OSError as e:
+            self.failed(e)
+
+    def syncDir(self, src, dst, name, st, dst_st, follow, parents):
+        if dst_st is not None and not stat.S_ISDIR(dst_st.st_mode):
+            if not self.replace(dst, dst_st):
+                return
+            dst_st = None
+        if dst_st is None:
+            self.printName(name + os.sep if name else '.' + os.sep)
+            if not _simulate:
+                os.mkdir(dst, 0o700)
+        if not _simulate:
+            self.dirs.append((dst, st))
+
+        names = sorted(os.listdir(src))
+        if _delete and dst_st is not None:
+            self.existing[dst] = name
+        for entry in names:
+            self.syncEntry(path.join(src, entry), path.join(name, entry),
+                           self.follow, parents)
+
+    def syncFile(self, src, dst, name, st, dst_st):
+        if dst_st is not None:
+            if stat.S_ISREG(dst_st.st_mode) and \
+               dst_st.st_size == st.st_size and \
+               dst_st.st_mtime_ns == st.st_mtime_ns:
+                if not _simulate:
+                    self.setAttrs(dst, st, dst_st)
+                return
+            if stat.S_ISDIR(dst_st.st_mode) and not self.replace(dst, dst_st):
+                return
+
+        self.printName(name or path.basename(src))
+        self.files += 1
+        self.bytes += st.st_size
+        if not _simulate:
+            self.submit(self.copyFile, src, dst, st)
+
+    def syncLink(self, src, dst, name, st, dst_st):
+        target = os.readlink(src)
+        if dst_st is not None:
+            if stat.S_ISLNK(dst_st.st_mode) and os.readlink(dst) == target:
+                if not _simulate:
+                    self.setAttrs(dst, st, dst_st)
+                return
+            if stat.S_ISDIR(dst_st.st_mode) and not self.replace(dst, dst_st):
+                return
+
+        self.printName(name + ' -> ' + target)
+        if not _simulate:
+            temp = self.tempName(dst)
+            os.symlink(target, temp)
+            self.setAttrs(temp, st)
+            os.replace(temp, dst)
+
+    def syncSpecial(self, dst, name, st, dst_st):
+        if dst_st is not None:
+            if stat.S_IFMT(dst_st.st_mode) == stat.S_IFMT(st.st_mode) and \
+               dst_st.st_rdev == st.st_rdev:
+                if not _simulate:
+                    self.setAttrs(dst, st, dst_st)
+                return
+            if stat.S_ISDIR(dst_st.st_mode) and not self.replace(dst, dst_st):
+                return
+
+        self.printName(name)
+        if not _simulate:
+            temp = self.tempName(dst)
+            os.mknod(temp, stat.S_IFMT(st.st_mode) | 0o600, st.st_rdev)
+            self.setAttrs(temp, st)
+            os.replace(temp, dst)
+
+    def prune(self):
+        # other entries may still sync into a directory, and their copies
+        # have temporary names, so delete only once everything is in place
+        while self.pending:
+            self.pending.popleft().result()
+        if self.errors and self.existing:
+            PrintError("IO error encountered -- skipping file deletion")
+            return
+        for dst, name in self.existing.items():
+            try:
+                self.deleteExtraneous(dst, name, self.keep.get(dst, set()))
+            except OSError as e:
+                self.failed(e)
+
+    def deleteExtraneous(self, dst, name, names):
+        extraneous = sorted(set(os.listdir(dst)) - names)
+        if not extraneous:
+            return
+        self.deleted += len(extraneous)
+        if _simulate:
+            for entry in extraneous:
+                print("deleting", path.join(name, entry))
+            return
+        dir_fd = os.open(dst, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            for entry in extraneous:
+                count, size, errors = removeAt(dir_fd, entry,
+                                               path.join(dst, entry),
+                                               removeFailed)
+                if errors:
+                    updateStatus(23)
+        finally:
+            os.close(dir_fd)
+
+    def replace(self, dst, dst_st):
+        if not _delete and stat.S_ISDIR(dst_st.st_mode) and \
+           os.listdir(dst):
+            PrintError(shortPath(dst), "cannot delete non-empty directory")
+            updateStatus(23)
+            return False
+        if _simulate:
+            return True
+        count, size, errors = removeTree(dst, removeFailed)
+        return errors == 0
+
+    def copyFile(self, src, dst, st):
+        temp = self.tempName(dst)
+        try:
+            with open(src, 'rb') as src_file, open(temp, 'xb') as dst_file:
+                copyData(src_file.fileno(), dst_file.fileno())
+                self.setAttrs(dst_file.fileno(), st)
+            os.replace(temp, dst)
+        except OSError as e:
+            try:
+                os.unlink(temp)
+            except OSError:
+                pass
+            self.failed(e)
+
+    def setAttrs(self, dst, st, dst_st=None):
+        follow = not stat.S_ISLNK(st.st_mode)
+        if dst_st is None or \
+           (dst_st.st_uid, dst_st.st_gid) != (st.st_uid, st.st_gid):
+            try:
+                if _root:
+                    os.chown(dst, st.st_uid, st.st_gid,
+                             follow_symlinks=follow)
+                else:
+                    os.chown(dst, -1, st.st_gid, follow_symlinks=follow)
+            except PermissionError:
+                pass
+        if follow and (dst_st is None or dst_st.st_mode != st.st_mode):
+            os.chmod(dst, stat.S_IMODE(st.st_mode))
+        if dst_st is None or dst_st.st_mtime_ns != st.st_mtime_ns:
+            os.utime(dst, ns=(time_ns(), st.st_mtime_ns),
+                     follow_symlinks=follow)
+
+    def tempName(self, dst):
+        dir, base = path.split(dst)
+        return path.join(dir, '.%s.%d.%d' % (base, os.getpid(),
+                                             threading.get_ident()))
+
+    def submit(self, func, *args):
+        if len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(func, *args))
+
+    def printName(self, name):
+        if _simulate:
+            print(name)
+
+    def failed(self, e):
+        PrintError(e.filename and shortPath(e.filename), e.strerror)
+        updateStatus(23)
+        self.errors = True
+
+    def finish(self):
+        while self.pending:
+            self.pending.popleft().result()
+        self.executor.shutdown()
+        for dst, st in reversed(self.dirs):
+            try:
+                self.setAttrs(dst, st, os.lstat(dst))
+            except OSError as e:
+                self.failed(e)
 
-    runProc(_rsync_default + options + srcList + [ _dest ])
+def copyData(src_fd, dst_fd):
+    for copy in (getattr(os, 'copy_file_range', None), os.sendfile):
+        if copy is None:
+            continue
+        try:
+            while True:
+                if copy is os.sendfile:
+                    count = os.sendfile(dst_fd, src_fd, None, _bufsize * 8)
+                else:
+                    count = copy(src_fd, dst_fd, _bufsize * 8)
+                if count == 0:
+                    return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                               errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+
+    while True:
+        data = os.read(src_fd, _bufsize)
+        if not data:
+            return
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst_fd, view) : ]
+
+class WatchDir:
+
+    def __init__(self, name):
+        self.path = name
+        self.tree = None    # (base, follow) if the whole directory is synced
+        self.files = {}     # name: (base, follow) of entries in the directory
+        self.ops = set()    # plan ops that may match new files in it
+
+class Watcher:
+
+    def __init__(self, debounce):
+        import ctypes, ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise Fatal("inotify", os.strerror(ctypes.get_errno()))
+        self.debounce = debounce
+        self.dirs = {}      # watch descriptor: WatchDir
+        self.tops = {}      # path of a watched entry directory: entry
+        self.entries = {}   # entry: (relative, follow)
+        self.ops = []
+        self.dirty = {}     # path: (base, follow)
+        self.dirty_ops = set()
+        self.overflow = False
+        self.full = False
+        self.dest = path.abspath(_dest)
+
+    def addPlan(self, plan):
+        for op in plan.ops:
+            self.ops.append(op)
+            self.watchPattern(len(self.ops) - 1)
+
+    def addEntry(self, entry, relative, follow):
+        if entry in self.entries:
+            return False
+        self.entries[entry] = (relative, follow)
+        if entry in _remote_entries:
+            return True
 
-def extglob(pat):
-    out = runProc( [ _extglob, pat ],
-                   stdout=PIPE, stderr=PIPE, ignore_code=True )[0]
-    return [ line for line in out.split('\n') if line ]
+        name = path.join(_rundir, entry)
+        if relative:
+            pos = name.find(_relative_pat)
+            base = (name[ : pos] or os.sep) if pos >= 0 else None
+        elif entry.endswith(os.sep):
+            base = name.rstrip(os.sep) or os.sep
+        else:
+            base = path.dirname(name.rstrip(os.sep))
+        top = name.replace(_relative_pat, os.sep).rstrip(os.sep) or os.sep
 
+        try:
+            st = os.stat(top) if follow or entry.endswith(os.sep) else \
+                 os.lstat(top)
+        except OSError:
+            return True
+        if stat.S_ISDIR(st.st_mode):
+            self.tops[top] = entry
+            self.addTree(top, base, follow)
+        else:
+            parent, file = path.split(top)
+            watch = self.addWatch(parent)
+            if watch is not None:
+                watch.files[file] = (base, follow)
+        return True
+
+    def addTree(self, top, base, follow):
+        stack, seen = [ top ], set()
+        while stack:
+            dir = stack.pop()
+            if dir == self.dest:
+                continue
+            watch = self.addWatch(dir)
+            if watch is None:
+                continue
+            watch.tree = (base, follow)
+            try:
+                with os.scandir(dir) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=follow):
+                            if follow:
+                                st = entry.stat()
+                                if (st.st_dev, st.st_ino) in seen:
+                                    continue
+                                seen.add((st.st_dev, st.st_ino))
+                            stack.append(entry.path)
+            except OSError:
+                pass
+
+    def watchPattern(self, index):
+        op = self.ops[index]
+        pattern, implied_pat = op[1], op[3]
+        if _source and implied_pat:
+            pattern = path.join(_source, implied_pat)
+        if _re_remote.match(pattern):
+            return
+
+        parts = path.join(_rundir, pattern).split(os.sep)
+        static = len(parts) - 1
+        for i, part in enumerate(parts):
+            if _re_magic.search(part) or _glob is extglob and \
+               _re_glob_part.search(part):
+                static = min(i, static)
+                break
+        for i in range(static, len(parts)):
+            prefix = os.sep.join(parts[ : i]) or os.sep
+            dirs = _glob(_dircache, prefix) if i > static else [ prefix ]
+            for dir in dirs:
+                watch = self.addWatch(path.normpath(dir))
+                if watch is not None:
+                    watch.ops.add(index)
+
+    def addWatch(self, dir):
+        mask = (0x00000004 |    # IN_ATTRIB
+                0x00000008 |    # IN_CLOSE_WRITE
+                0x00000040 |    # IN_MOVED_FROM
+                0x00000080 |    # IN_MOVED_TO
+                0x00000100 |    # IN_CREATE
+                0x00000200 |    # IN_DELETE
+                0x01000000 |    # IN_ONLYDIR
+                0x04000000)     # IN_EXCL_UNLINK
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir), mask)
+        if wd < 0:
+            import ctypes
+            code = ctypes.get_errno()
+            if code == errno.ENOSPC and not self.full:
+                PrintError("inotify", "too many directories to watch "
+                           "(see fs.inotify.max_user_watches)")
+                updateStatus(1)
+                self.full = True
+            elif code not in (errno.ENOENT, errno.ENOTDIR, errno.ENOSPC):
+                PrintError(shortPath(dir), os.strerror(code))
+                updateStatus(1)
+            return None
+        try:
+            return self.dirs[wd]
+        except KeyError:
+            watch = self.dirs[wd] = WatchDir(dir)
+            return watch
+
+    def readEvents(self):
+        import struct
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, size = struct.unpack_from('iIII', data, pos)
+                name = os.fsdecode(data[pos + 16 : pos + 16 + size]
+                                   .rstrip(b'\0'))
+                pos += 16 + size
+                self.handleEvent(wd, mask, name)
+
+    def handleEvent(self, wd, mask, name):
+        if mask & 0x00004000:           # IN_Q_OVERFLOW
+            self.overflow = True
+            return
+        watch = self.dirs.get(wd)
+        if watch is None:
+            return
+        if mask & 0x00008000:           # IN_IGNORED
+            del self.dirs[wd]
+            entry = self.tops.pop(watch.path, None)
+            if entry is not None:
+                del self.entries[entry]
+            return
+        if not name:
+            return
+
+        child = path.join(watch.path, name)
+        created = mask & (0x00000100 | 0x00000080)  # IN_CREATE, IN_MOVED_TO
+        for index in watch.ops:
+            if created or self.ops[index][0] == 'purge':
+                self.dirty_ops.add(index)
+        target = watch.tree or watch.files.get(name)
+        if target is not None:
+            self.dirty[child] = target
+            if watch.tree and created and mask & 0x40000000:    # IN_ISDIR
+                self.addTree(child, *watch.tree)
+
+    def pending(self):
+        return bool(self.dirty or self.dirty_ops or self.overflow)
+
+    def sync(self):
+        global _dircache
+        _dircache = DirCache()
+
+        if self.overflow:
+            PrintError("inotify", "event queue overflowed; syncing everything")
+            self.dirty_ops.update(range(len(self.ops)))
+            for entry, key in self.entries.items():
+                _queues[key].append(entry)
+        ops, self.dirty_ops = sorted(self.dirty_ops), set()
+        dirty, self.dirty = self.dirty, {}
+        self.overflow = False
+
+        for index in ops:
+            op = self.ops[index]
+            processPattern(op[0] == 'purge', *op[1:])
+            self.watchPattern(index)
+
+        synced = set()
+        for name in sorted(dirty):
+            base, follow = dirty[name]
+            if not path.lexists(name):
+                if not _delete or base is None:
+                    continue
+                while not path.lexists(name):
+                    name = path.dirname(name)
+                if len(name) <= len(base):
+                    continue
+            parent = name
+            while parent not in synced and path.dirname(parent) != parent:
+                parent = path.dirname(parent)
+            if parent in synced:
+                continue
+            synced.add(name)
+            queueAdd(anchoredPath(base, name), True, follow, watch=False)
+
+        if any(_queues.values()):
+            TestPrint(_verbose, "syncing" if not _simulate else
+                      "would sync", sum(map(len, _queues.values())),
+                      "changed entries")
+            if not (_verbose and _simulate):
+                runQueues()
+            for srcList in _queues.values():
+                del srcList[:]
+            TestPrint(_verbose)
+
+    def run(self):
+        global _pipes
+        _pipes = None
+        for srcList in _queues.values():
+            del srcList[:]
+
+        import select
+        poll = select.poll()
+        poll.register(self.fd, select.POLLIN)
+        TestPrint(_verbose, "watching", len(self.dirs),
+                  "directories for changes")
+        while True:
+            poll.poll()
+            self.readEvents()
+            deadline = perf_counter() + 10 * self.debounce
+            while perf_counter() < deadline and \
+                  poll.poll(self.debounce * 1000):
+                self.readEvents()
+            if self.pending():
+                self.sync()
+
+def anchoredPath(base, name):
+    if base is None:
+        return name
+    return base.rstrip(os.sep) + _relative_pat + \
+           name[len(base) : ].lstrip(os.sep)
+
+def runQueues():
+    with _stats.phase(_engine):
+        runTasks()
+
+def runTasks():
+    tasks = []
+    for (relative, follow), srcList in _queues.items():
+        if srcList:
+            for shard in shardList(srcList, relative, _shards):
+                tasks.append((shard, relative, follow))
+
+    if _engine == 'native':
+        for task in tasks:
+            nativeList(*task)
+        return
+
+    if _jobs < 2 or len(tasks) < 2:
+        for task in tasks:
+            rsyncList(*task)
+        return
+
+    TestPrint(_verbose, "running", len(tasks), "rsync processes,",
+              min(_jobs, len(tasks)), "at a time")
+    with ThreadPoolExecutor(min(_jobs, len(tasks))) as executor:
+        for future in [ executor.submit(rsyncList, *task) for task in tasks ]:
+            future.result()
 
 def updateStatus(code):
     global _status, _num_errors
-    if code == 0:
-        _status = 0
-        _num_errors = 0
-    else:
-        _status = max(_status, code)
-        _num_errors += 1
+    with _status_lock:
+        if code == 0:
+            _status = 0
+            _num_errors = 0
+        else:
+            _status = max(_status, code)
+            _num_errors += 1
 
 def instantiateGlobals():
-    global _rundir, _filedir
+    global _rundir
     global _children
-    global _extglob
+    global _stats, _stats_file
+    global _status_lock
+    global _dircache
     global _queues
+    global _remote_entries
     global _rsync_default
-    _rundir, _filedir = os.getcwd(), None
+    global _bufsize
+    global _root
+    global _piped, _sync_printed
+    _rundir = os.getcwd()
     _children = set()
-    _extglob = "extglob"
+    _stats, _stats_file = Stats(), None
+    _status_lock = threading.Lock()
+    _dircache = DirCache()
     _queues = {}
+    _piped, _sync_printed = {}, False
     for relative in (True, False):
         for follow in (True, False):
             _queues[(relative, follow)] = []
+    _remote_entries = set()
     _rsync_default = [ 'rsync', '-a' ]
+    _bufsize = 1024 * 1024
+    _root = os.geteuid() == 0
 
     global _relative_pat
     global _purge_chr
@@ -410,6 +1304,8 @@ def instantiateGlobals():
     global _re_repeated_relative
     global _re_implied_part
     global _re_glob_part
+    global _re_magic
+    global _re_remote
     global _re_home
     _relative_pat = os.sep + '.' + os.sep
     _purge_chr, _copy_chr, _link_chr = '!', '%', '@'
@@ -434,18 +1330,27 @@ def instantiateGlobals():
                                r'\[[!^][^' + s + r']+\]|'
                                r'[*?+@!]\([^' + s + r']+\)'
                                r').*$')
+    _re_magic = re.compile(r'[*?[]')
+    _re_remote = re.compile(r'^(?:[^' + s + r':]+:|rsync://)')
     _re_home = re.compile(r'^' + path.expanduser('~'))
 
 def parseOptions(argv):
     global _rsync_default
     global _dest
     global _source
+    global _cache
     global _simulate
     global _deref
     global _verbose
     global _purge
     global _remote
     global _glob
+    global _jobs, _shards
+    global _pipes
+    global _engine
+    global _delete
+    global _stats_file
+    global _watch
 
     from optparse import OptionParser, OptParseError
     class OptParser(OptionParser):
@@ -472,6 +1377,14 @@ def parseOptions(argv):
                           help='options to pass to rsync in addition to the '
                                'defaults ("' + ' '.join(_rsync_default[1:]) +
                                '"); for example: --options="-cu --exclude=.git"')
+        parser.add_option("--cache", metavar="DIR",
+                          help='save compiled input files in DIR and reuse '
+                               'them while the files and the files they '
+                               'include are unchanged')
+        parser.add_option("--stats", metavar="FILE",
+                          help='write the time spent in each phase, the '
+                               'number of entries queued and purged and the '
+                               'child processes run to FILE as JSON')
         parser.add_option("-d", "--delete", default=False, action="store_true",
                           help='pass the "--delete" option to rsync')
         parser.add_option("-z", "--compress", default=False, action="store_true",
@@ -495,8 +1408,35 @@ def parseOptions(argv):
                           help='print messages from ' + __prog__ + ' (use '
                                '--options for rsync verbosity)')
         parser.add_option("-e", "--extglob", default=False, action="store_true",
-                          help="enable bash extended globbing (requires "
-                               "`" + _extglob + "' in $PATH)")
+                          help='enable bash extended globbing (as with the '
+                               '"extglob" and "dotglob" shell options)')
+        parser.add_option("--jobs", metavar="N", type="int",
+                          default=os.cpu_count() or 1,
+                          help='run up to N rsync processes at the same time '
+                               '(default is the number of processors)')
+        parser.add_option("--shards", metavar="N", type="int", default=1,
+                          help='split the entries passed to each rsync process '
+                               'into up to N groups by top-level destination '
+                               'entry, and transfer each group with its own '
+                               'rsync process (default is 1)')
+        parser.add_option("--engine", metavar="ENGINE", default="rsync",
+                          type="choice", choices=[ "rsync", "native" ],
+                          help='transfer files with ENGINE, which is either '
+                               '"rsync" (the default) or "native", a built-in '
+                               'engine for local sources and destinations')
+        parser.add_option("--pipeline", default=False, action="store_true",
+                          help='start rsync while input files are still being '
+                               'read, and pass entries to it as they are '
+                               'found')
+        parser.add_option("--watch", default=False, action="store_true",
+                          help='after the first transfer, keep running and '
+                               'transfer files again as they change, as well '
+                               'as new files matching the patterns')
+        parser.add_option("--debounce", metavar="SECONDS", type="float",
+                          default=2.0,
+                          help='with --watch, wait until no changes have '
+                               'been seen for SECONDS seconds before '
+                               'transferring them (default is %default)')
         opts, args = parser.parse_args(argv[1:])
 
         if opts.help:
@@ -521,6 +1461,7 @@ def parseOptions(argv):
 
         _dest = opts.target
         _source = opts.source
+        _cache = opts.cache and path.abspath(path.expanduser(opts.cache))
 
         options = []
         for opt_str in opts.options:
@@ -548,7 +1489,43 @@ def parseOptions(argv):
         if opts.extglob:
             _glob = extglob
         else:
-            _glob = glob
+            _glob = fileglob
+
+        _jobs = opts.jobs
+        if _jobs < 1:
+            raise OptParseError("invalid number of jobs: %d" % _jobs)
+        _shards = opts.shards
+        if _shards < 1:
+            raise OptParseError("invalid number of shards: %d" % _shards)
+
+        _engine = opts.engine
+        _delete = opts.delete
+        if _engine == 'native':
+            if opts.options:
+                raise OptParseError("rsync options cannot be used with the "
+                                    "native engine")
+            if _re_remote.match(_dest):
+                raise OptParseError("the native engine needs a local "
+                                    "destination")
+
+        if opts.pipeline and _engine == 'rsync' and \
+           not (_verbose and _simulate):
+            _pipes = {}
+        else:
+            _pipes = None
+
+        _stats_file = opts.stats and path.abspath(path.expanduser(opts.stats))
+
+        if opts.watch:
+            if not sys.platform.startswith('linux'):
+                raise OptParseError("--watch needs inotify, which is only "
+                                    "available on Linux")
+            if opts.debounce <= 0:
+                raise OptParseError("invalid debounce interval: %g" %
+                                    opts.debounce)
+            _watch = Watcher(opts.debounce)
+        else:
+            _watch = None
 
         return args
 
@@ -570,8 +1547,8 @@ def main(argv=None):
         global __prog__
         __prog__ = path.basename(argv[0])
 
-        updateStatus(0)
         instantiateGlobals()
+        updateStatus(0)
 
         args = parseOptions(argv)
 
@@ -594,29 +1571,42 @@ def main(argv=None):
                     PrintError(e.filename, e.strerror)
                     updateStatus(1)
 
-        if _verbose and any(_queues.values()):
-            ProgPrint("destination is set to", shortPath(_dest))
-            ProgPrint('invoking rsync with "' if not _simulate else
-                      'rsync would be invoked with "',
-                      ' '.join(_rsync_default[1:]), '"', sep='')
+        TestPrint(_verbose, "directory cache:", _dircache.hits, "hits,",
+                            _dircache.misses, "misses")
+        if any(_queues.values()):
+            printSync()
+        if _pipes:
+            with _stats.phase('rsync'):
+                closePipes()
+        for (relative, follow), srcList in _queues.items():
+            entries = len(srcList) + _piped.get((relative, follow), 0)
+            if entries:
+                _stats.add('queues', { 'relative': relative, 'follow': follow,
+                                       'entries': entries })
         if not (_verbose and _simulate):
-            for flags in _queues:
-                rsyncList(_queues[flags], flags[0], flags[1])
+            runQueues()
 
         if _status == 0:
             TestPrint(_verbose and not _simulate, "done")
         else:
             TestPrint(_verbose, _num_errors, " error",
                       's' if _num_errors > 1 else '', sep='')
+        if _watch is not None:
+            TestPrint(_verbose)
+            _watch.run()
+        if _stats_file:
+            saveStats(_status)
         return _status
 
     except Exit as e:
         PrintError(*e.args)
+        if _stats_file:
+            saveStats(e.status)
         return e.status
 
     finally:
         try:
-            for proc in _children:
+            for proc in list(_children):
                 proc.send_signal(signum)
         except NameError:
             pass